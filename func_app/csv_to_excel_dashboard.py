@@ -2,12 +2,13 @@ import datetime
 import io
 import os
 import json
-import pandas as pd
-from azure.storage.blob import BlobServiceClient
+import pickle
+import time
+from collections import namedtuple
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.chart import BarChart, LineChart, PieChart, Reference
-from openpyxl.utils.dataframe import dataframe_to_rows
+from rollups import load_summary_index, rollup_summary, top_hosts
+from storage import get_storage
 
 # --- Excel Style Definitions ---
 # Color styles used throughout the Excel workbook for headers and metric highlighting
@@ -17,64 +18,54 @@ FILL = PatternFill(start_color="a4f114", end_color="a4f114", fill_type="solid")
 GROUP_HEADER_FILL = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid") # Blue for Group headers
 
 
-def generate_excel(container_name):
-    """
-    Main function responsible for:
-    1. Connecting to Azure Blob Storage and setting up the container.
-    2. Downloading host group information (optional JSON file).
-    3. Downloading and processing all CSV metric files into a consolidated structure.
-    4. Creating an Excel workbook with Dashboard and All Hosts sheets.
-    5. Styling and formatting the data in the Excel sheets.
-    6. Uploading the final Excel report and cleaning up CSV files.
-    """
+# Columns of a per-host metric row, as stored in the per-host CSVs
+ROW_COLUMNS = ["Metric", "Min", "Max", "Avg", "Unit", "Samples"]
 
-    # --- Azure Connection and Setup ---
-    connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-    if not connect_str:
-        raise ValueError("AZURE_STORAGE_CONNECTION_STRING is not configured")
 
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-    container_client = blob_service_client.get_container_client(container_name)
+def global_averages(host_rows):
+    """
+    Returns (cpu_avg, memory_avg) over the per-host averages of CPU and memory metrics.
+    """
+    global_cpu_values = []
+    global_mem_values = []
+    for rows in host_rows.values():
+        for row in rows:
+            m = str(row[0]).lower()
+            try:
+                val = float(row[3])
+                if 'cpu' in m and ('util' in m or 'usage' in m): global_cpu_values.append(val)
+                elif 'mem' in m and ('utilization' in m or 'pavailable' in m): global_mem_values.append(val)
+            except: pass
 
-    # Attempt to create container (it will pass if container already exists)
-    try:
-        container_client.create_container()
-    except:
-        pass
+    cpu_avg = sum(global_cpu_values)/len(global_cpu_values) if global_cpu_values else 0
+    mem_avg = sum(global_mem_values)/len(global_mem_values) if global_mem_values else 0
+    return cpu_avg, mem_avg
 
-    # --- Load Host Group Information (Optional) ---
-    try:
-        groups_blob = container_client.get_blob_client("_hostgroups_info.json")
-        groups_info = json.loads(groups_blob.download_blob().content_as_text())
-        host_to_groups = groups_info.get('host_to_groups', {})
-        groups_data = groups_info.get('groups', {})
-    except:
-        print(f"[{container_name}] No host groups info found, continuing without group data")
-        host_to_groups = {}
-        groups_data = {}
 
-    # --- Download and Process CSV Metric Files ---
-    host_count = 0
-    csv_data = {}
-    csv_blobs_processed = []
+def group_membership(host_rows, host_to_groups):
+    """
+    Returns {group_name: [host_name, ...]} for the hosts present in the report.
+    Hosts without group information are listed under "Unknown".
+    """
+    groups = {}
+    for host_name in host_rows:
+        for group in host_to_groups.get(host_name, ["Unknown"]):
+            groups.setdefault(group, []).append(host_name)
+    return groups
 
-    for blob in container_client.list_blobs():
-        # ONLY process files ending with .csv and not starting with '_'
-        # This prevents re-analyzing old reports or metadata
-        if blob.name.lower().endswith(".csv") and not blob.name.startswith("_"):
-            blob_client = container_client.get_blob_client(blob.name)
-            try:
-                stream = io.StringIO(blob_client.download_blob().content_as_text())
-                csv_data[blob.name] = pd.read_csv(stream)
-                csv_blobs_processed.append(blob.name)
-                host_count += 1
-            except Exception as e:
-                print(f"[{container_name}] Error reading CSV {blob.name}: {e}")
 
-    if not csv_data:
-        print(f"[{container_name}] No CSV data found. Skipping Excel generation.")
-        return
+def build_workbook(host_rows, host_to_groups, period="Last 30 days", group_sections=True, summary_index=None):
+    """
+    Builds the Excel report and returns it as bytes.
 
+    host_rows: {host_name: [(metric, min, max, avg, unit, samples), ...]}
+    host_to_groups: {host_name: [group_name, ...]}
+    group_sections: when True, the Dashboard repeats every host's rows under
+        each of its groups. When False (compact report), a "Group Index" sheet
+        lists group membership instead and rows appear only once.
+    summary_index: rollup index (see rollups.py). When given, global averages,
+        the group summary and top hosts are read from it.
+    """
     # --- Create Workbook and "All Hosts" Sheet ---
     wb = Workbook()
     ws_all = wb.active 
@@ -93,22 +84,22 @@ def generate_excel(container_name):
     group_metrics = {} 
 
     # Populate "All Hosts" sheet and aggregate group metrics
-    for csv_name, df in csv_data.items():
-        host_name = csv_name.replace(".csv", "")
+    for host_name, rows in host_rows.items():
         groups_str = ";".join(host_to_groups.get(host_name, ["Unknown"]))
 
-        for _, row in df.iterrows():
-            unit = row.get('Unit', '')
-            ws_all.append([host_name, row['Metric'], row['Min'], row['Max'], row['Avg'], unit, row['Samples'], groups_str])
+        for metric, min_val, max_val, avg_val, unit, samples in rows:
+            ws_all.append([host_name, metric, min_val, max_val, avg_val, unit, samples, groups_str])
+            row_count += 1
+            if not group_sections:
+                continue
 
             for group in host_to_groups.get(host_name, ["Unknown"]):
                 group_metrics.setdefault(group, {})
                 group_metrics[group].setdefault(host_name, [])
                 group_metrics[group][host_name].append({
-                    'metric': row['Metric'], 'min': row['Min'], 'max': row['Max'],
-                    'avg': row['Avg'], 'unit': unit, 'samples': row['Samples']
+                    'metric': metric, 'min': min_val, 'max': max_val,
+                    'avg': avg_val, 'unit': unit, 'samples': samples
                 })
-            row_count += 1
 
     # --- Create "Dashboard" Sheet ---
     ws_dashboard = wb.create_sheet("Dashboard", 0)
@@ -118,29 +109,30 @@ def generate_excel(container_name):
     ws_dashboard['B3'] = f"Generated: {datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}"
     ws_dashboard['B3'].font = Font(size=10, italic=True)
 
+    groups = group_membership(host_rows, host_to_groups)
+
     # Statistics
-    stats = [["Total Hosts", host_count], ["Total Metrics", row_count - 2], ["Total Host Groups", len(group_metrics)], ["Period", "Last 30 days"]]
+    stats = [["Total Hosts", len(host_rows)], ["Total Metrics", row_count - 2], ["Total Host Groups", len(groups)], ["Period", period]]
     row_start = 5
     for i, row in enumerate(stats, start=row_start):
         ws_dashboard.cell(i, 2, row[0]).font = Font(bold=True)
         ws_dashboard.cell(i, 4, row[1]).font = Font(size=11)
 
-    # Calculate Global Averages
-    global_cpu_values = []
-    global_mem_values = []
-    for df in csv_data.values():
-        for _, row in df.iterrows():
-            m = row['Metric'].lower()
-            try:
-                val = float(row['Avg'])
-                if 'cpu' in m and ('util' in m or 'usage' in m): global_cpu_values.append(val)
-                elif 'mem' in m and ('utilization' in m or 'pavailable' in m): global_mem_values.append(val)
-            except: pass
+    # Global Averages: sample-weighted from the rollup index, or recomputed from
+    # rows for rollups the index does not have (e.g. catalogs without "rollup")
+    cpu_avg, mem_avg = (_rollup_mean(summary_index, r) for r in ("cpu", "memory"))
+    if cpu_avg is None or mem_avg is None:
+        row_cpu_avg, row_mem_avg = global_averages(host_rows)
+        cpu_avg = row_cpu_avg if cpu_avg is None else cpu_avg
+        mem_avg = row_mem_avg if mem_avg is None else mem_avg
 
     ws_dashboard.cell(row_start + len(stats) + 1, 2, "Global CPU Avg (%)").font = Font(bold=True)
-    ws_dashboard.cell(row_start + len(stats) + 1, 4, sum(global_cpu_values)/len(global_cpu_values) if global_cpu_values else 0).number_format = '0.00'
+    ws_dashboard.cell(row_start + len(stats) + 1, 4, cpu_avg).number_format = '0.00'
     ws_dashboard.cell(row_start + len(stats) + 2, 2, "Global Memory Avg (%)").font = Font(bold=True)
-    ws_dashboard.cell(row_start + len(stats) + 2, 4, sum(global_mem_values)/len(global_mem_values) if global_mem_values else 0).number_format = '0.00'
+    ws_dashboard.cell(row_start + len(stats) + 2, 4, mem_avg).number_format = '0.00'
+
+    if summary_index:
+        _add_rollup_tables(ws_dashboard, summary_index, row_start + len(stats) + 4)
 
     # Detailed Group Sections (Simplified display)
     group_col_start = 9 
@@ -171,21 +163,222 @@ def generate_excel(container_name):
                 group_row += 1
         group_row += 2
 
-    # --- Save and Upload Excel File ---
+    if not group_sections:
+        _add_group_index(wb, ws_dashboard, groups)
+
+    # --- Serialize Workbook ---
     excel_output = io.BytesIO()
     wb.save(excel_output)
-    filename = f"Zabbix_Report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    container_client.get_blob_client(filename).upload_blob(excel_output.getvalue(), overwrite=True)
-    print(f"[{container_name}] Excel '{filename}' uploaded successfully.")
+    return excel_output.getvalue()
+
+
+def _rollup_mean(summary_index, rollup):
+    summary = rollup_summary(summary_index, rollup)
+    return summary.mean if summary else None
+
+
+def _add_rollup_tables(ws_dashboard, summary_index, row):
+    """
+    Adds the per-group summary and the top CPU hosts to the Dashboard, below
+    the global statistics (columns B-F).
+    """
+    groups = set()
+    for rollup in ("cpu", "memory"):
+        groups.update(summary_index.get("rollups", {}).get(rollup, {}).get("groups", {}))
+
+    headers = ["Group", "CPU Avg (%)", "CPU Max (%)", "Memory Avg (%)", "Memory Max (%)"]
+    for idx, h in enumerate(headers, start=2):
+        cell = ws_dashboard.cell(row, idx, h)
+        cell.fill = HEADER_FILL
+        cell.font = HEADER_FONT
+    row += 1
+    for group_name in sorted(groups):
+        ws_dashboard.cell(row, 2, group_name)
+        for col, rollup in ((3, "cpu"), (5, "memory")):
+            summary = rollup_summary(summary_index, rollup, group=group_name)
+            if summary:
+                ws_dashboard.cell(row, col, summary.mean).number_format = '0.00'
+                ws_dashboard.cell(row, col + 1, summary.max).number_format = '0.00'
+        row += 1
+
+    row += 1
+    for idx, h in enumerate(["Top Hosts by CPU", "CPU Avg (%)"], start=2):
+        cell = ws_dashboard.cell(row, idx, h)
+        cell.fill = HEADER_FILL
+        cell.font = HEADER_FONT
+    row += 1
+    for host_name, mean in top_hosts(summary_index, "cpu"):
+        ws_dashboard.cell(row, 2, host_name)
+        ws_dashboard.cell(row, 3, mean).number_format = '0.00'
+        row += 1
+
+
+def _add_group_index(wb, ws_dashboard, groups):
+    """
+    Adds the compact-report group views: a host count per group on the
+    Dashboard and a "Group Index" sheet with one (Group, Host) row per membership.
+    """
+    group_col_start = 9
+    ws_dashboard.cell(2, group_col_start, "Host Groups")
+    ws_dashboard.cell(2, group_col_start).fill = GROUP_HEADER_FILL
+    ws_dashboard.cell(2, group_col_start).font = Font(color="FFFFFF", bold=True)
+    ws_dashboard.merge_cells(start_row=2, start_column=group_col_start, end_row=2, end_column=group_col_start + 1)
+    for idx, h in enumerate(["Group", "Hosts"], start=group_col_start):
+        cell = ws_dashboard.cell(3, idx, h)
+        cell.fill = HEADER_FILL
+        cell.font = HEADER_FONT
+    for row, group_name in enumerate(sorted(groups), start=4):
+        ws_dashboard.cell(row, group_col_start, group_name)
+        ws_dashboard.cell(row, group_col_start + 1, len(groups[group_name]))
+
+    ws_index = wb.create_sheet("Group Index")
+    ws_index.append(["Group", "Host"])
+    for col in (1, 2):
+        cell = ws_index.cell(1, col)
+        cell.fill = HEADER_FILL
+        cell.font = HEADER_FONT
+        cell.alignment = Alignment(horizontal="center")
+    for group_name in sorted(groups):
+        for host_name in sorted(groups[group_name]):
+            ws_index.append([group_name, host_name])
+
+
+# Everything a report render needs; csv_blobs is only used for cleanup after upload
+ReportInputs = namedtuple("ReportInputs", ["host_rows", "host_to_groups", "summary_index", "formats", "basename", "csv_blobs"])
+
+
+def load_report_inputs(container_name, storage, formats=None):
+    """
+    Downloads host group information, the per-host CSVs and the rollup index
+    into a ReportInputs, or returns None if there is no CSV data.
+    """
+    # Imported here so the on-demand report path (which never reads CSVs) does not load pandas
+    import pandas as pd
+    from report_formats import get_report_formats
+
+    if formats is None:
+        formats = get_report_formats()
+
+    # --- Load Host Group Information (Optional) ---
+    try:
+        groups_info = json.loads(storage.get_text("_hostgroups_info.json"))
+        host_to_groups = groups_info.get('host_to_groups', {})
+    except:
+        print(f"[{container_name}] No host groups info found, continuing without group data")
+        host_to_groups = {}
+
+    # --- Download and Process CSV Metric Files ---
+    host_rows = {}
+    csv_blobs_processed = []
+
+    for blob in storage.list():
+        # ONLY process files ending with .csv and not starting with '_'
+        # This prevents re-analyzing old reports or metadata
+        if blob.name.lower().endswith(".csv") and not blob.name.startswith("_"):
+            try:
+                with storage.stream(blob.name) as stream:
+                    df = pd.read_csv(stream)
+                df["Unit"] = df["Unit"].fillna("") if "Unit" in df else ""
+                host_rows[blob.name[:-len(".csv")]] = df[ROW_COLUMNS].values.tolist()
+                csv_blobs_processed.append(blob.name)
+            except Exception as e:
+                print(f"[{container_name}] Error reading CSV {blob.name}: {e}")
+
+    if not host_rows:
+        print(f"[{container_name}] No CSV data found. Skipping Excel generation.")
+        return None
+
+    # --- Load Rollup Summary Index (Optional) ---
+    summary_index = load_summary_index(storage)
+    if summary_index is None:
+        print(f"[{container_name}] No summary index found, global averages are recomputed from rows")
+
+    basename = f"Zabbix_Report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    return ReportInputs(host_rows, host_to_groups, summary_index, formats, basename, csv_blobs_processed)
+
+
+def render_report_inputs(inputs):
+    """
+    Renders all formats of a ReportInputs. Returns a list of (filename, bytes).
+    """
+    from report_formats import render_reports
+
+    return render_reports(
+        inputs.host_rows, inputs.host_to_groups, inputs.formats, inputs.basename,
+        summary_index=inputs.summary_index
+    )
+
+
+def serialize_report_inputs(inputs):
+    """
+    Pickles the fields of a ReportInputs needed for rendering, for a worker process.
+    """
+    return pickle.dumps(inputs._replace(csv_blobs=[]), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def render_report_payload(payload):
+    """
+    Process-pool entry point: unpickles a serialized ReportInputs and renders it.
+    Returns (outputs, timings) with the unpickle and render times in ms.
+    """
+    start = time.perf_counter()
+    inputs = pickle.loads(payload)
+    unpickled = time.perf_counter()
+    outputs = render_report_inputs(inputs)
+    rendered = time.perf_counter()
+    return outputs, {
+        "unpickle_ms": (unpickled - start) * 1000,
+        "render_ms": (rendered - unpickled) * 1000,
+    }
+
+
+def publish_reports(container_name, storage, inputs, outputs):
+    """
+    Uploads rendered reports and deletes the processed CSV files.
+    Returns the names of the uploaded report files.
+    """
+    if not outputs:
+        print(f"[{container_name}] No report could be rendered for formats {inputs.formats}. Keeping CSV files.")
+        return []
+
+    # --- Upload Report Files ---
+    for filename, data in outputs:
+        storage.put(filename, data)
+        print(f"[{container_name}] Report '{filename}' uploaded successfully ({len(data)} bytes).")
 
     # --- Cleanup: Delete processed CSV files ---
-    print(f"[{container_name}] Cleaning up {len(csv_blobs_processed)} processed CSV files...")
-    for b in csv_blobs_processed:
+    print(f"[{container_name}] Cleaning up {len(inputs.csv_blobs)} processed CSV files...")
+    for b in inputs.csv_blobs:
         try:
-            container_client.delete_blob(b)
+            storage.delete(b)
         except Exception as e:
             print(f"[{container_name}] Failed to delete {b}: {e}")
 
+    return [filename for filename, _ in outputs]
+
+
+def generate_excel(container_name, storage=None, formats=None):
+    """
+    Main function responsible for:
+    1. Connecting to the storage backend and setting up the container.
+    2. Downloading host group information (optional JSON file).
+    3. Downloading and processing all CSV metric files into a consolidated structure.
+    4. Rendering the selected report formats (default: the Excel dashboard).
+    5. Uploading the reports and cleaning up CSV files.
+
+    Returns the names of the uploaded report files.
+    """
+    # --- Storage Connection and Setup ---
+    if storage is None:
+        storage = get_storage(container_name)
+    storage.ensure_container()
+
+    inputs = load_report_inputs(container_name, storage, formats)
+    if inputs is None:
+        return []
+
+    return publish_reports(container_name, storage, inputs, render_report_inputs(inputs))
+
 
 if __name__ == "__main__":
     cname = os.getenv("CONTAINER_NAME", "metrics")
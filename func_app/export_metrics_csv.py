@@ -4,7 +4,10 @@ import datetime
 import io
 import os
 import json
-from azure.storage.blob import BlobServiceClient
+from collections import namedtuple
+from metric_catalog import MetricCatalog, load_catalog
+from rollups import SUMMARY_INDEX_BLOB, RollupBuilder
+from storage import get_storage
 
 # Create a session with SSL verification enabled
 session = requests.Session()
@@ -45,79 +48,242 @@ def zabbix_api(url, method, params, auth=None):
     
     return result["result"]
 
-def convert_value(value, item_key, item_name):
+def zabbix_login(zabbix_url, zabbix_user, zabbix_password):
     """
-    Converts raw metric values depending on their type.
+    Authenticates to Zabbix and returns the auth token.
+    Tries the older ("user") and then the modern ("username") parameter naming.
+    """
+    try:
+        return zabbix_api(zabbix_url, "user.login", {"user": zabbix_user, "password": zabbix_password})
+    except:
+        return zabbix_api(zabbix_url, "user.login", {"username": zabbix_user, "password": zabbix_password})
+
+def get_hosts(zabbix_url, auth_token, group_names=None):
+    """
+    Retrieves hosts with their groups, optionally limited to hosts belonging
+    to any of the given host group names.
+    """
+    params = {
+        "output": ["hostid", "host", "name"],
+        "selectGroups": ["groupid", "name"]
+    }
+    if group_names:
+        groups = zabbix_api(zabbix_url, "hostgroup.get", {
+            "output": ["groupid"],
+            "filter": {"name": list(group_names)}
+        }, auth_token)
+        if not groups:
+            return []
+        params["groupids"] = [g["groupid"] for g in groups]
+
+    return zabbix_api(zabbix_url, "host.get", params, auth_token)
+
+def get_catalog_items(zabbix_url, auth_token, host_ids, catalog):
+    """
+    Retrieves the items of the given host(s) selected by the catalog.
+    Returns a list of (item, MetricSpec) pairs; extra keys matched by a
+    prefix search are dropped.
+    """
+    items = zabbix_api(zabbix_url, "item.get", {
+        "hostids": host_ids,
+        "output": ["itemid", "hostid", "name", "key_", "value_type", "units"],
+        **catalog.item_get_params()
+    }, auth_token)
+
+    pairs = []
+    for item in items:
+        spec = catalog.resolve(item["key_"])
+        if spec is not None:
+            pairs.append((item, spec))
+    return pairs
+
+def get_trends(zabbix_url, auth_token, item_ids, time_from, time_till):
+    """
+    Retrieves trends for several items in a single request, grouped by itemid.
+    """
+    trends = zabbix_api(zabbix_url, "trend.get", {
+        "itemids": item_ids,
+        "time_from": time_from,
+        "time_till": time_till,
+        "output": ["itemid", "clock", "min", "max", "avg", "num"]
+    }, auth_token)
+
+    trends_by_item = {}
+    for t in trends:
+        trends_by_item.setdefault(t["itemid"], []).append(t)
+    return trends_by_item
 
-    - CPU metrics are already percentages.
-    - Memory size values come in bytes, convert them to GB.
-    - Memory utilization and pavailable are already percentages.
+def get_history(zabbix_url, auth_token, item, time_from, time_till, sortorder="ASC", limit=10000):
     """
+    Retrieves raw history values of one item, sorted by clock.
+    """
+    # Determine correct history type
+    history_type = 0 if int(item["value_type"]) == 0 else 3
+    return zabbix_api(zabbix_url, "history.get", {
+        "itemids": item["itemid"],
+        "time_from": time_from,
+        "time_till": time_till,
+        "output": "extend",
+        "history": history_type,
+        "sortfield": "clock",
+        "sortorder": sortorder,
+        "limit": limit
+    }, auth_token)
+
+def aggregate_trends(trends, spec):
+    """
+    Reduces trend buckets to (min, max, avg, sample count) in report units.
+
+    The conversion factor is linear, so it is applied once to the reduced
+    values instead of to every bucket.
+    """
+    min_raw = float("inf")
+    max_raw = float("-inf")
+    total_sum = 0.0
+    total_count = 0
+    last_clock = -1
+    last_avg = 0.0
+
+    for t in trends:
+        t_min = float(t["min"])
+        t_max = float(t["max"])
+        t_avg = float(t["avg"])
+        t_num = int(t["num"])
+        if t_min < min_raw:
+            min_raw = t_min
+        if t_max > max_raw:
+            max_raw = t_max
+        # Weighted average based on sample counts
+        total_sum += t_avg * t_num
+        total_count += t_num
+        clock = int(t.get("clock", 0))
+        if clock >= last_clock:
+            last_clock = clock
+            last_avg = t_avg
+
+    if spec.aggregation == "last":
+        avg_raw = last_avg
+    else:
+        avg_raw = total_sum / total_count if total_count > 0 else 0
+
+    return min_raw * spec.factor, max_raw * spec.factor, avg_raw * spec.factor, total_count
+
+
+def _history_value(h):
     try:
-        val = float(value)
-        
-        # Convert memory size from bytes to gigabytes
-        if 'vm.memory.size' in item_key and 'pavailable' not in item_key:
-            return val / (1024**3)
-        
-        return val
-        
+        return float(h["value"])
     except (ValueError, TypeError):
         return 0.0  # safe fallback for invalid numeric values
 
-def format_value(value, item_key):
+
+def aggregate_history(history, spec, latest=None):
     """
-    Formats output values consistently for CSV export.
-    Memory values in GB and percentages are formatted with 2 decimals.
+    Reduces raw history values (sorted by clock ASC) to (min, max, avg, sample count) in report units.
+    Invalid numeric values count as 0.0.
+
+    `latest` is the most recent history record of the window; "last" metrics
+    need it because `history` is a truncated page that may end before the
+    window does.
     """
-    if 'vm.memory.size' in item_key and 'pavailable' not in item_key:
-        return f"{value:.2f}"
+    values = [_history_value(h) for h in history]
+
+    if spec.aggregation == "last":
+        avg_raw = _history_value(latest) if latest is not None else values[-1]
     else:
-        return f"{value:.2f}"
+        avg_raw = sum(values) / len(values)
+
+    return min(values) * spec.factor, max(values) * spec.factor, avg_raw * spec.factor, len(values)
+
 
-def get_unit_label(item_key):
+def visible_group_names(group_names, group_filter):
     """
-    Returns a label representing the measurement unit for each item.
+    Returns the host group names a client may see: all of them without a
+    filter, otherwise only its own (other tenants' group names on a shared
+    server must not leak into its reports).
     """
-    if 'vm.memory.size' in item_key and 'pavailable' not in item_key:
-        return "GB"
-    elif 'cpu' in item_key.lower() or 'utilization' in item_key or 'pavailable' in item_key:
-        return "%"
-    else:
-        return ""
+    if not group_filter:
+        return group_names
+    return [name for name in group_names if name in group_filter]
+
+
+# One client's share of an export: where to write, which metrics, which host groups
+ExportTarget = namedtuple("ExportTarget", ["container_name", "catalog", "group_names", "storage"])
 
-def export_metrics(zabbix_url, zabbix_user, zabbix_password, container_name):
+
+class _TargetState:
     """
-    Main execution function:
-    - Connects to Azure Blob Storage
-    - Authenticates to Zabbix API
-    - Retrieves host groups, hosts and metrics
-    - Collects trends or history data
-    - Converts data and exports CSV files per host
-    - Stores host group mapping in JSON format
+    Per-target accumulators while hosts of a shared discovery are processed.
     """
-    # Azure Blob Storage configuration
-    connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-    if not connect_str:
-        raise ValueError("AZURE_STORAGE_CONNECTION_STRING is not configured")
-    
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-    container_client = blob_service_client.get_container_client(container_name)
 
-    # Create container if missing
-    if not container_client.exists():
-        container_client.create_container()
-        print(f"Container '{container_name}' created")
-    else:
-        print(f"Container '{container_name}' already exists")
+    def __init__(self, target, host_groups):
+        self.target = target
+        self.group_filter = set(target.group_names) if target.group_names else None
+        # Unfiltered targets keep every host group (as a single-client export
+        # always did); filtered targets only list their own groups holding hosts.
+        self.hostgroup_data = {
+            group['groupid']: {'name': group['name'], 'hosts': []}
+            for group in host_groups
+            if self.group_filter is None or group['name'] in self.group_filter
+        }
+        self.host_to_groups = {}
+        self.rollups = RollupBuilder()
+        self.hosts_processed = 0
+        self.hosts_with_data = 0
+
+    def includes(self, group_names):
+        return self.group_filter is None or not self.group_filter.isdisjoint(group_names)
+
+    def visible_groups(self, group_names):
+        return visible_group_names(group_names, self.group_filter)
+
+
+def export_metrics(zabbix_url, zabbix_user, zabbix_password, container_name, catalog=None, storage=None):
+    """
+    Exports the metrics of a single client (all hosts visible to the user).
+    See export_metrics_shared for the details.
+    """
+    if catalog is None:
+        catalog = load_catalog()
+    export_metrics_shared(zabbix_url, zabbix_user, zabbix_password, [
+        ExportTarget(container_name, catalog, None, storage)
+    ])
+
+
+def export_metrics_shared(zabbix_url, zabbix_user, zabbix_password, targets):
+    """
+    Main execution function, for one or more clients hosted on the same Zabbix server:
+    - Connects to each client's storage backend (Azure Blob Storage by default)
+    - Authenticates to Zabbix API once
+    - Retrieves host groups and hosts once, and the metrics selected by the union of the catalogs
+    - Collects trends or history data once per item
+    - Splits hosts per client by host group filter (required when there are
+      several targets), converts data with each
+      client's catalog and exports CSV files per host
+    - Stores host group mapping and the rollup summary index in JSON format per client
+    """
+    # Without a host group filter a target would receive every host on the server
+    unfiltered = [t.container_name for t in targets if not t.group_names]
+    if len(targets) > 1 and unfiltered:
+        raise ValueError(
+            f"Targets {unfiltered} share a Zabbix server with other targets but have no "
+            f"host group filter. Refusing to export mixed tenant data."
+        )
+
+    targets = [
+        t._replace(storage=t.storage or get_storage(t.container_name))
+        for t in targets
+    ]
+
+    for target in targets:
+        # Create container if missing
+        if target.storage.ensure_container():
+            print(f"Container '{target.container_name}' created")
+        else:
+            print(f"Container '{target.container_name}' already exists")
 
     print(f"Authenticating to Zabbix at {zabbix_url}...")
 
-    # Attempt user.login with modern and older parameter naming
-    try:
-        auth_token = zabbix_api(zabbix_url, "user.login", {"user": zabbix_user, "password": zabbix_password})
-    except:
-        auth_token = zabbix_api(zabbix_url, "user.login", {"username": zabbix_user, "password": zabbix_password})
+    auth_token = zabbix_login(zabbix_url, zabbix_user, zabbix_password)
 
     print("Authentication successful")
 
@@ -129,187 +295,181 @@ def export_metrics(zabbix_url, zabbix_user, zabbix_password, container_name):
     end_time = int(datetime.datetime.now().timestamp())
     start_time = int((datetime.datetime.now() - datetime.timedelta(days=30)).timestamp())
 
-    # Metrics to collect
-    TARGET_KEYS = [
-        "system.cpu.util",
-        "system.cpu.util[,idle]",
-        "system.cpu.util[,iowait]",
-        "system.cpu.util[,system]",
-        "system.cpu.util[,user]",
-        "system.cpu.util[,steal]",
-        "system.cpu.num",
-        "vm.memory.utilization",
-        "vm.memory.size[available]",
-        "vm.memory.size[pavailable]",
-        "vm.memory.size[used]",
-        "vm.memory.size[total]",
-    ]
-
     # Retrieve all host groups
     print("Getting host groups...")
     host_groups = zabbix_api(zabbix_url, "hostgroup.get", {"output": ["groupid", "name"]}, auth_token)
     print(f"Found {len(host_groups)} host groups")
-    
-    # Prepare structure to store host group data
-    hostgroup_data = {}
-    for group in host_groups:
-        hostgroup_data[group['groupid']] = {
-            'name': group['name'],
-            'hosts': []
-        }
 
-    # Retrieve all hosts with their groups
-    hosts = zabbix_api(zabbix_url, "host.get", {
-        "output": ["hostid", "host", "name"],
-        "selectGroups": ["groupid", "name"]
-    }, auth_token)
-    
-    hosts_processed = 0
-    hosts_with_data = 0
-    host_to_groups = {}
+    states = [_TargetState(t, host_groups) for t in targets]
+
+    # Retrieve hosts with their groups (only the filtered groups if every target has a filter)
+    group_filter = None
+    if all(state.group_filter for state in states):
+        group_filter = sorted(set().union(*(state.group_filter for state in states)))
+    hosts = get_hosts(zabbix_url, auth_token, group_filter)
+
+    # Discovery uses the union of the catalogs; each target converts with its own
+    discovery_catalog = states[0].target.catalog if len(states) == 1 else MetricCatalog.union([t.catalog for t in targets])
 
     # Process each host individually
     for host in hosts:
         host_id = host["hostid"]
         host_name = host["host"]
-        
-        # Track host's group names
-        host_to_groups[host_name] = [g['name'] for g in host.get('groups', [])]
-        
-        # Map host to groups in the main dict
-        for group in host.get('groups', []):
-            if group['groupid'] in hostgroup_data:
-                hostgroup_data[group['groupid']]['hosts'].append(host_name)
-
-        # Retrieve items belonging to this host
-        items = zabbix_api(zabbix_url, "item.get", {
-            "hostids": host_id,
-            "output": ["itemid", "name", "key_", "value_type", "units"],
-            "filter": {"key_": TARGET_KEYS}
-        }, auth_token)
+        group_names = [g['name'] for g in host.get('groups', [])]
+
+        host_states = [state for state in states if state.includes(group_names)]
+        if not host_states:
+            continue
+
+        for state in host_states:
+            # Track host's group names (filtered targets only see their own groups)
+            state.host_to_groups[host_name] = state.visible_groups(group_names)
+
+            # Map host to groups in the main dict
+            for group in host.get('groups', []):
+                if group['groupid'] in state.hostgroup_data:
+                    state.hostgroup_data[group['groupid']]['hosts'].append(host_name)
+
+        # Retrieve catalog items belonging to this host
+        items = [item for item, _ in get_catalog_items(zabbix_url, auth_token, host_id, discovery_catalog)]
 
         if not items:
             continue
 
-        # Prepare CSV writer in memory
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(["Metric", "Min", "Max", "Avg", "Samples", "Host_Groups", "Unit"])
-        has_data = False
-
-        # Process each metric
-        for item in items:
-            item_id = item["itemid"]
-            item_name = item["name"]
-            item_key = item["key_"]
-            value_type = int(item["value_type"])
-            groups_str = ";".join(host_to_groups.get(host_name, []))
-            unit_label = get_unit_label(item_key)
-
-            # Attempt trends first
-            try:
-                trends = zabbix_api(zabbix_url, "trend.get", {
-                    "itemids": item_id,
-                    "time_from": start_time,
-                    "time_till": end_time,
-                    "output": ["min", "max", "avg", "num"]
-                }, auth_token)
-
-                # If trend data exists, calculate properly
-                if trends and len(trends) > 0:
-                    min_val = convert_value(min(float(t["min"]) for t in trends), item_key, item_name)
-                    max_val = convert_value(max(float(t["max"]) for t in trends), item_key, item_name)
-                    
-                    # Weighted average based on sample counts
-                    total_sum = sum(convert_value(float(t["avg"]), item_key, item_name) * int(t["num"]) for t in trends)
-                    total_count = sum(int(t["num"]) for t in trends)
-                    avg_val = total_sum / total_count if total_count > 0 else 0
-                    
-                    writer.writerow([
-                        item_name, 
-                        format_value(min_val, item_key), 
-                        format_value(max_val, item_key), 
-                        format_value(avg_val, item_key), 
-                        len(trends), 
-                        groups_str,
-                        unit_label
-                    ])
-                    has_data = True
-                    print(f"[TRENDS] {host_name} - {item_name}: min={min_val:.2f}, max={max_val:.2f}, avg={avg_val:.2f}")
-                    continue
-                else:
-                    print(f"[WARNING] No trends data for {host_name} - {item_name}, falling back to history")
-                    
-            except Exception as e:
-                print(f"[ERROR] Processing trends for {host_name} - {item_name}: {e}")
-
-            # Fallback to raw history when trends are unavailable
-            try:
-                # Determine correct history type
-                history_type = 0 if value_type == 0 else 3
-                history = zabbix_api(zabbix_url, "history.get", {
-                    "itemids": item_id,
-                    "time_from": start_time,
-                    "time_till": end_time,
-                    "output": "extend",
-                    "history": history_type,
-                    "sortfield": "clock",
-                    "sortorder": "ASC",
-                    "limit": 10000
-                }, auth_token)
-
-                if not history:
-                    continue
-
-                # Convert raw values
-                values = [convert_value(h["value"], item_key, item_name) for h in history]
-                min_val = min(values)
-                max_val = max(values)
-                avg_val = sum(values) / len(values)
-                
-                writer.writerow([
-                    item_name, 
-                    format_value(min_val, item_key), 
-                    format_value(max_val, item_key), 
-                    format_value(avg_val, item_key), 
-                    len(values), 
-                    groups_str,
-                    unit_label
-                ])
-                has_data = True
-                print(f"[HISTORY] {host_name} - {item_name}: min={min_val:.2f}, max={max_val:.2f}, avg={avg_val:.2f}")
-                
-            except Exception as e:
-                print(f"[ERROR] Processing history for {host_name} - {item_name}: {e}")
+        # Fetch trends for all items of the host in a single request
+        trends_by_item = {}
+        try:
+            trends_by_item = get_trends(zabbix_url, auth_token, [item["itemid"] for item in items], start_time, end_time)
+        except Exception as e:
+            print(f"[ERROR] Processing trends for {host_name}: {e}")
+
+        # History fallback results, shared by the targets that include this host
+        history_by_item = {}
+        latest_by_item = {}
+
+        def load_history(item, latest=False):
+            if latest:
+                # Most recent value of the window, for "last" metrics
+                if item["itemid"] not in latest_by_item:
+                    page = get_history(zabbix_url, auth_token, item, start_time, end_time, sortorder="DESC", limit=1)
+                    latest_by_item[item["itemid"]] = page[0] if page else None
+                return latest_by_item[item["itemid"]]
+
+            if item["itemid"] not in history_by_item:
+                history_by_item[item["itemid"]] = get_history(zabbix_url, auth_token, item, start_time, end_time)
+            return history_by_item[item["itemid"]]
+
+        for state in host_states:
+            item_specs = []
+            for item in items:
+                spec = state.target.catalog.resolve(item["key_"])
+                if spec is not None:
+                    item_specs.append((item, spec))
+
+            csv_text = _host_csv(host_name, state.host_to_groups[host_name], item_specs, trends_by_item, load_history, state.rollups)
+
+            # Upload CSV to storage
+            if csv_text is not None:
+                state.target.storage.put(f"{host_name}.csv", csv_text)
+                state.hosts_with_data += 1
+
+            state.hosts_processed += 1
+
+    for state in states:
+        container_name = state.target.container_name
+        hostgroup_data = state.hostgroup_data
+        if state.group_filter is not None:
+            hostgroup_data = {gid: data for gid, data in hostgroup_data.items() if data['hosts']}
+
+        # Save host group mapping into JSON for additional reference
+        groups_info = {
+            'groups': {
+                gid: {'name': data['name'], 'hosts': data['hosts']} 
+                for gid, data in hostgroup_data.items()
+            },
+            'host_to_groups': state.host_to_groups,
+            'generation_date': datetime.datetime.now().isoformat()
+        }
+        
+        state.target.storage.put("_hostgroups_info.json", json.dumps(groups_info, indent=2))
+        print(f"Host groups info saved for {container_name}")
+
+        # Save per-host / per-group / per-client rollups for the Dashboard and notifications
+        state.target.storage.put(SUMMARY_INDEX_BLOB, json.dumps(state.rollups.build(), separators=(",", ":")))
+        print(f"Summary index saved for {container_name}")
+
+        print(f"\n[{container_name}] Hosts processed: {state.hosts_processed}, Hosts with data: {state.hosts_with_data}")
+
+
+def _host_csv(host_name, group_names, item_specs, trends_by_item, load_history, rollups):
+    """
+    Builds the CSV of one host for one target, or returns None if no metric has data.
+    Trends are used when available; otherwise raw history (loaded via load_history,
+    which returns the latest record of the window when called with latest=True).
+    """
+    # Prepare CSV writer in memory
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["Metric", "Min", "Max", "Avg", "Samples", "Host_Groups", "Unit"])
+    has_data = False
+    groups_str = ";".join(group_names)
+
+    # Process each metric
+    for item, spec in item_specs:
+        item_name = item["name"]
+        unit_label = spec.unit if spec.unit is not None else item.get("units", "")
+
+        item_trends = trends_by_item.get(item["itemid"])
+        if item_trends:
+            min_val, max_val, avg_val, samples = aggregate_trends(item_trends, spec)
+            rollups.add_metric(host_name, group_names, spec, min_val, max_val, avg_val, samples)
+            writer.writerow([
+                item_name, 
+                f"{min_val:.2f}", 
+                f"{max_val:.2f}", 
+                f"{avg_val:.2f}", 
+                len(item_trends), 
+                groups_str,
+                unit_label
+            ])
+            has_data = True
+            print(f"[TRENDS] {host_name} - {item_name}: min={min_val:.2f}, max={max_val:.2f}, avg={avg_val:.2f}")
+            continue
+
+        print(f"[WARNING] No trends data for {host_name} - {item_name}, falling back to history")
+
+        # Fallback to raw history when trends are unavailable
+        try:
+            history = load_history(item)
+
+            if not history:
                 continue
 
-        # Upload CSV to Azure Blob Storage
-        if has_data:
-            blob_client = container_client.get_blob_client(f"{host_name}.csv")
-            blob_client.upload_blob(output.getvalue(), overwrite=True)
-            hosts_with_data += 1
-        
-        hosts_processed += 1
-
-    # Save host group mapping into JSON for additional reference
-    groups_info = {
-        'groups': {
-            gid: {'name': data['name'], 'hosts': data['hosts']} 
-            for gid, data in hostgroup_data.items()
-        },
-        'host_to_groups': host_to_groups,
-        'generation_date': datetime.datetime.now().isoformat()
-    }
-    
-    groups_blob = container_client.get_blob_client("_hostgroups_info.json")
-    groups_blob.upload_blob(json.dumps(groups_info, indent=2), overwrite=True)
-    print(f"Host groups info saved for {container_name}")
+            latest = load_history(item, latest=True) if spec.aggregation == "last" else None
+            min_val, max_val, avg_val, samples = aggregate_history(history, spec, latest)
+            rollups.add_metric(host_name, group_names, spec, min_val, max_val, avg_val, samples)
+            
+            writer.writerow([
+                item_name, 
+                f"{min_val:.2f}", 
+                f"{max_val:.2f}", 
+                f"{avg_val:.2f}", 
+                samples, 
+                groups_str,
+                unit_label
+            ])
+            has_data = True
+            print(f"[HISTORY] {host_name} - {item_name}: min={min_val:.2f}, max={max_val:.2f}, avg={avg_val:.2f}")
+            
+        except Exception as e:
+            print(f"[ERROR] Processing history for {host_name} - {item_name}: {e}")
+            continue
 
-    print(f"\nHosts processed: {hosts_processed}, Hosts with data: {hosts_with_data}")
+    return output.getvalue() if has_data else None
 
 if __name__ == "__main__":
     ZABBIX_URL = os.getenv("ZABBIX_URL")
     ZABBIX_USER = os.getenv("ZABBIX_USER")
     ZABBIX_PASSWORD = os.getenv("ZABBIX_PASSWORD")
     CONTAINER_NAME = os.getenv("CONTAINER_NAME", "metrics")
-    export_metrics(ZABBIX_URL, ZABBIX_USER, ZABBIX_PASSWORD, CONTAINER_NAME)
\ No newline at end of file
+    export_metrics(ZABBIX_URL, ZABBIX_USER, ZABBIX_PASSWORD, CONTAINER_NAME, load_catalog())
\ No newline at end of file
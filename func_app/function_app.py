@@ -1,19 +1,132 @@
+import importlib
+import json
 import logging
-import azure.functions as func
-from export_metrics_csv import export_metrics
-from csv_to_excel_dashboard import generate_excel
-from send_to_teams import (
-    generate_container_sas,
-    list_container_files,
-    send_to_teams_workflow,
-    SAS_EXPIRY_HOURS,
-    ONLY_LATEST_FILE
-)
 import os
-from datetime import datetime
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, urlunsplit
+
+_MODULE_LOAD_START = time.perf_counter()
+
+import azure.functions as func
+
+# Log the import cost of each pipeline stage and its heavy dependencies
+IMPORT_PROFILE = os.getenv('IMPORT_PROFILE', 'false').lower() == 'true'
+
+# Worker processes used to render reports when several clients are processed (0 = inline)
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', '0'))
+
+# Heavy third-party dependencies pulled in by each stage module.
+# They are imported (and timed) individually before the stage itself, so the
+# profile shows where the cold-start time actually goes.
+STAGE_DEPENDENCIES = {
+    'export_metrics_csv': ['requests'],
+    'csv_to_excel_dashboard': ['pandas', 'openpyxl'],
+    'send_to_teams': ['requests', 'azure.storage.blob'],
+}
+
+
+def _timed_import(module_name: str):
+    """
+    Imports a module, logging its cost when IMPORT_PROFILE is enabled.
+    Modules already loaded are returned as-is and are not reported.
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    if not IMPORT_PROFILE:
+        return importlib.import_module(module_name)
+
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    logging.info(f"[startup] import {module_name}: {elapsed_ms:.1f} ms")
+    return module
+
+
+def _load_stage(module_name: str):
+    """
+    Loads a pipeline stage module on first use, so heavy dependencies
+    (pandas, openpyxl, requests, Azure SDK) are only paid for by the stage
+    that needs them instead of on every cold start.
+    """
+    for dependency in STAGE_DEPENDENCIES.get(module_name, []):
+        _timed_import(dependency)
+    return _timed_import(module_name)
+
 
 app = func.FunctionApp()
 
+if IMPORT_PROFILE:
+    logging.info(f"[startup] function_app loaded in {(time.perf_counter() - _MODULE_LOAD_START) * 1000:.1f} ms")
+
+def _get_clients() -> list:
+    """
+    Returns the configured client ids (CLIENTS, comma-separated).
+    """
+    return [c.strip() for c in os.getenv('CLIENTS', '').split(',') if c.strip()]
+
+
+def _get_zabbix_credentials(client: str) -> tuple:
+    """
+    Returns (url, user, password) for a client from ZABBIX_*_{CLIENT} settings.
+    """
+    zabbix_url = os.getenv(f'ZABBIX_URL_{client.upper()}')
+    zabbix_user = os.getenv(f'ZABBIX_USER_{client.upper()}')
+    zabbix_password = os.getenv(f'ZABBIX_PASSWORD_{client.upper()}')
+
+    if not all([zabbix_url, zabbix_user, zabbix_password]):
+        raise ValueError(f"Missing Zabbix credentials for client '{client}' in environment variables.")
+
+    return zabbix_url, zabbix_user, zabbix_password
+
+
+def _get_host_group_filter(client: str) -> list:
+    """
+    Returns the host group names a client is limited to (ZABBIX_HOSTGROUPS_{CLIENT},
+    comma-separated), or None for all hosts visible to its Zabbix user.
+    """
+    groups = [g.strip() for g in os.getenv(f'ZABBIX_HOSTGROUPS_{client.upper()}', '').split(',') if g.strip()]
+    return groups or None
+
+
+def _normalize_zabbix_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), parts.query, ''))
+
+
+def _group_clients_by_server(clients: list) -> tuple:
+    """
+    Groups clients that share a Zabbix server and credentials, so their
+    discovery and trend downloads happen once. Returns
+    ([(credentials, [client, ...]), ...], [(client, error), ...]) in
+    configuration order; clients with missing credentials are left out of
+    the groups and returned with their error. Nothing is logged here.
+    """
+    groups = {}
+    failures = []
+    for client in clients:
+        try:
+            zabbix_url, zabbix_user, zabbix_password = _get_zabbix_credentials(client)
+        except ValueError as e:
+            failures.append((client, e))
+            continue
+        key = (_normalize_zabbix_url(zabbix_url), zabbix_user, zabbix_password)
+        groups.setdefault(key, ((zabbix_url, zabbix_user, zabbix_password), []))[1].append(client)
+    return list(groups.values()), failures
+
+
+def _unfiltered_shared_clients(server_clients: list) -> list:
+    """
+    Returns the clients of a shared Zabbix server that have no host group
+    filter. They would receive every host on the server, including the
+    other clients' hosts, so the server's clients are not exported.
+    """
+    if len(server_clients) < 2:
+        return []
+    return [client for client in server_clients if not _get_host_group_filter(client)]
+
+
 @app.schedule(
     schedule="0 0 1 * *",  # Day 1 of each month at 00:00
     arg_name="mytimer",
@@ -24,86 +137,282 @@ def monthly_metrics_export(mytimer: func.TimerRequest) -> None:
     start_time = datetime.now()
     logging.info("Starting Multi-Client Zabbix Metrics extraction")
     
-    clients_str = os.getenv('CLIENTS', '')
-    if not clients_str:
+    clients = _get_clients()
+    if not clients:
         logging.error("No CLIENTS configured in environment variables. Check your configuration.")
         return
 
-    clients = [c.strip() for c in clients_str.split(',') if c.strip()]
     logging.info(f"Identified {len(clients)} clients to process: {clients}")
 
-    for client in clients:
-        logging.info(f">>> Processing Client: {client.upper()} <<<")
-        container_name = f"metrics-{client}"
-        
-        try:
-            # 1. Fetch Credentials
-            zabbix_url = os.getenv(f'ZABBIX_URL_{client.upper()}')
-            zabbix_user = os.getenv(f'ZABBIX_USER_{client.upper()}')
-            zabbix_password = os.getenv(f'ZABBIX_PASSWORD_{client.upper()}')
-
-            if not all([zabbix_url, zabbix_user, zabbix_password]):
-                raise ValueError(f"Missing Zabbix credentials for client '{client}' in environment variables.")
-
-            # Step 1: Export metrics from Zabbix API
-            logging.info(f"[{client}] Connecting to Zabbix API...")
-            export_metrics(zabbix_url, zabbix_user, zabbix_password, container_name)
-            
-            # Step 2: Generate Excel Dashboard and cleanup CSVs
-            logging.info(f"[{client}] Processing dashboard and cleaning up temporary CSVs...")
-            generate_excel(container_name)
-            
-            # Step 3: Notify Teams
-            logging.info(f"[{client}] Generating secure links and notifying Teams...")
-            send_to_teams(client, container_name)
-            
-            logging.info(f"[{client}] Successfully processed.")
-            
-        except Exception as e:
-            # Robust error handling: Log the specific failure but continue with the next client
-            logging.error(f"!!! CRITICAL FAILURE for client '{client}' !!!")
-            logging.error(f"Error details: {str(e)}")
-            logging.info(f"Proceeding to the next client in the list...")
-            continue
+    # Optional process pool for CPU-bound report rendering (REPORT_WORKERS > 0)
+    pool = _create_report_pool(len(clients))
+    pending = []
+
+    server_groups, failures = _group_clients_by_server(clients)
+    for client, error in failures:
+        _log_client_failure(client, error)
+
+    try:
+        for credentials, server_clients in server_groups:
+            zabbix_url, zabbix_user, zabbix_password = credentials
+            if len(server_clients) > 1:
+                logging.info(f">>> Shared Zabbix server for clients {[c.upper() for c in server_clients]}: single discovery <<<")
+
+            unfiltered = _unfiltered_shared_clients(server_clients)
+            if unfiltered:
+                error = ValueError(
+                    f"Clients {server_clients} share a Zabbix server but {unfiltered} have no "
+                    f"ZABBIX_HOSTGROUPS_<CLIENT> setting. Refusing to export mixed tenant data."
+                )
+                for client in server_clients:
+                    _log_client_failure(client, error)
+                continue
+
+            try:
+                # Step 1: Export metrics from Zabbix API (once per server, split per client)
+                logging.info(f"[{', '.join(server_clients)}] Connecting to Zabbix API...")
+                catalogs = _load_stage('metric_catalog')
+                exporter = _load_stage('export_metrics_csv')
+                exporter.export_metrics_shared(zabbix_url, zabbix_user, zabbix_password, [
+                    exporter.ExportTarget(f"metrics-{client}", catalogs.load_catalog(client), _get_host_group_filter(client), None)
+                    for client in server_clients
+                ])
+            except Exception as e:
+                for client in server_clients:
+                    _log_client_failure(client, e)
+                continue
+
+            for client in server_clients:
+                logging.info(f">>> Processing Client: {client.upper()} <<<")
+                container_name = f"metrics-{client}"
+                
+                try:
+                    formats = _load_stage('report_formats').get_report_formats(client)
+                    if pool is not None:
+                        # Step 2 (offloaded): render in a worker while the next client is exported
+                        job = _submit_report(pool, client, container_name, formats)
+                        if job is not None:
+                            pending.append(job)
+                            continue
+                        uploaded = []
+                    else:
+                        # Step 2: Generate Excel Dashboard and cleanup CSVs
+                        logging.info(f"[{client}] Processing dashboard and cleaning up temporary CSVs...")
+                        generate_excel = _load_stage('csv_to_excel_dashboard').generate_excel
+                        uploaded = generate_excel(container_name, formats=formats)
+
+                    # Otherwise the notification would re-announce the previous run's files
+                    if not uploaded:
+                        logging.warning(f"[{client}] No report was published. Notification skipped.")
+                        continue
+                    
+                    # Step 3: Notify Teams
+                    logging.info(f"[{client}] Generating secure links and notifying Teams...")
+                    send_to_teams(client, container_name)
+                    
+                    logging.info(f"[{client}] Successfully processed.")
+                    
+                except Exception as e:
+                    _log_client_failure(client, e)
+                    continue
+
+        # Collect offloaded renders: upload, cleanup CSVs and notify
+        for client, container_name, storage, inputs, future in pending:
+            try:
+                outputs, timings = future.result()
+                logging.info(f"[{client}] Worker rendered reports in {timings['render_ms']:.0f} ms (unpickle {timings['unpickle_ms']:.1f} ms)")
+                uploaded = _load_stage('csv_to_excel_dashboard').publish_reports(container_name, storage, inputs, outputs)
+                if not uploaded:
+                    logging.warning(f"[{client}] No report was published. Notification skipped.")
+                    continue
+
+                logging.info(f"[{client}] Generating secure links and notifying Teams...")
+                send_to_teams(client, container_name)
+
+                logging.info(f"[{client}] Successfully processed.")
+
+            except Exception as e:
+                _log_client_failure(client, e)
+                continue
+    finally:
+        if pool is not None:
+            pool.shutdown()
     
     end_time = datetime.now()
     duration = end_time - start_time
     logging.info(f"Multi-Client process completed. Total duration: {duration}")
 
 
+def _log_client_failure(client: str, error: Exception) -> None:
+    # Robust error handling: Log the specific failure but continue with the next client
+    logging.error(f"!!! CRITICAL FAILURE for client '{client}' !!!")
+    logging.error(f"Error details: {str(error)}")
+    logging.info(f"Proceeding to the next client in the list...")
+
+
+def _create_report_pool(client_count: int):
+    """
+    Returns a process pool for report rendering, or None to render inline.
+    A pool is only worth its start-up cost when several clients are processed.
+    Workers are spawned (not forked) so they do not inherit the host's threads.
+    """
+    if REPORT_WORKERS <= 0 or client_count < 2:
+        return None
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = min(REPORT_WORKERS, client_count, os.cpu_count() or 1)
+    logging.info(f"Rendering reports in a process pool with {workers} worker(s)")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _submit_report(pool, client: str, container_name: str, formats: list):
+    """
+    Loads a client's report inputs and submits the render to the pool.
+    Returns (client, container_name, storage, inputs, future), or None if there is no CSV data.
+    """
+    dashboard = _load_stage('csv_to_excel_dashboard')
+    storage = _load_stage('storage').get_storage(container_name)
+    storage.ensure_container()
+
+    inputs = dashboard.load_report_inputs(container_name, storage, formats)
+    if inputs is None:
+        return None
+
+    # Pickling cost is paid on this (I/O) thread; log it to see whether offloading pays off
+    start = time.perf_counter()
+    payload = dashboard.serialize_report_inputs(inputs)
+    pickle_ms = (time.perf_counter() - start) * 1000
+    logging.info(f"[{client}] Report payload {len(payload) / 1024:.1f} KiB pickled in {pickle_ms:.1f} ms, submitted to process pool")
+
+    return client, container_name, storage, inputs, pool.submit(dashboard.render_report_payload, payload)
+
+
+def _json_response(body: dict, status_code: int = 200, headers: dict = None) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps(body, default=str),
+        status_code=status_code,
+        mimetype="application/json",
+        headers=headers
+    )
+
+
+@app.route(route="reports/{client}", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def on_demand_report(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Builds (or serves from cache) a report for one client, optionally limited
+    to a set of host groups, and returns a time-limited download link.
+
+    Query parameters:
+    - groups: comma-separated host group names (default: all hosts)
+    - days: report window in days (default: 30)
+    """
+    start = time.perf_counter()
+    requested = req.route_params.get('client', '').strip()
+    client = {c.lower(): c for c in _get_clients()}.get(requested.lower())
+    if client is None:
+        return _json_response({"error": f"Unknown client '{requested}'"}, status_code=404)
+
+    reports = _load_stage('on_demand_report')
+    try:
+        days = int(req.params.get('days', '30'))
+    except ValueError:
+        days = 0
+    if not 1 <= days <= reports.MAX_REPORT_DAYS:
+        return _json_response({"error": f"'days' must be an integer between 1 and {reports.MAX_REPORT_DAYS}"}, status_code=400)
+
+    group_names = [g.strip() for g in req.params.get('groups', '').split(',') if g.strip()]
+
+    # Clients sharing a Zabbix server are limited to their own host groups
+    allowed_groups = _get_host_group_filter(client)
+    if not allowed_groups:
+        server_groups, _ = _group_clients_by_server(_get_clients())
+        for _, server_clients in server_groups:
+            if client in server_clients and _unfiltered_shared_clients(server_clients):
+                logging.error(f"[{client}] Shares a Zabbix server but has no ZABBIX_HOSTGROUPS setting")
+                return _json_response({"error": f"Client '{client}' has no host group filter configured"}, status_code=403)
+    if allowed_groups:
+        outside = sorted(set(group_names) - set(allowed_groups))
+        if outside:
+            return _json_response({"error": f"Host groups not available for client '{client}': {outside}"}, status_code=403)
+        group_names = group_names or allowed_groups
+
+    try:
+        storage = _load_stage('storage').get_storage(f"metrics-{client}")
+        catalog = _load_stage('metric_catalog').load_catalog(client)
+        meta = reports.build_on_demand_report(
+            storage,
+            client,
+            _get_zabbix_credentials(client),
+            catalog,
+            days=days,
+            group_names=group_names,
+            group_filter=allowed_groups
+        )
+    except Exception as e:
+        logging.error(f"[{client}] On-demand report failed: {str(e)}")
+        return _json_response({"error": "Report generation failed"}, status_code=502)
+
+    headers = {
+        "ETag": f'"{meta["etag"]}"',
+        "Cache-Control": f"private, max-age={reports.REPORT_CACHE_TTL_SECONDS}"
+    }
+    if req.headers.get('If-None-Match', '').strip('"') == meta["etag"]:
+        return func.HttpResponse(status_code=304, headers=headers)
+
+    sas_expiry_hours = int(os.getenv('SAS_EXPIRY_HOURS', '168'))
+    url, expiry_time = reports.report_link(storage, client, meta, sas_expiry_hours)
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    logging.info(f"[{client}] On-demand report served in {elapsed_ms:.0f} ms (cached={meta['cached']})")
+
+    return _json_response({
+        "client": client,
+        "url": url,
+        "expires": expiry_time.isoformat() if expiry_time else None,
+        "etag": meta["etag"],
+        "cached": meta["cached"],
+        "generated": datetime.fromtimestamp(meta["created"], timezone.utc).isoformat(),
+        "days": meta["days"],
+        "groups": meta["groups"],
+        "hosts": meta["hosts"]
+    }, headers=headers)
+
+
 def send_to_teams(client_id: str, container_name: str) -> None:
     """
     Generates SAS token and sends it to Teams via Workflow for a specific client
     """
-    connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+    storage = _load_stage('storage').get_storage(container_name)
+    if storage.kind != "azure":
+        logging.info(f"[{client_id}] Storage backend '{storage.kind}' does not support SAS links. Reports are in {storage.path}. Notification skipped.")
+        return
+
+    teams = _load_stage('send_to_teams')
+    connection_string = storage.connection_string
     webhook_url = os.getenv('TEAMS_WEBHOOK_URL', '')
     
-    if not connection_string:
-        raise ValueError("AZURE_STORAGE_CONNECTION_STRING environment variable is not set. Cannot generate SAS tokens.")
-    
     # Generate SAS token for container (read-only)
-    container_url, sas_token, expiry_time, account_name = generate_container_sas(
+    container_url, sas_token, expiry_time, account_name = teams.generate_container_sas(
         connection_string=connection_string,
         container_name=container_name,
-        expiry_hours=SAS_EXPIRY_HOURS
+        expiry_hours=teams.SAS_EXPIRY_HOURS
     )
     
-    # List Excel files (Only process .xlsx files, which were not deleted during cleanup)
-    files = list_container_files(
-        connection_string=connection_string,
-        container_name=container_name,
-        only_latest=ONLY_LATEST_FILE
-    )
+    # List report files (CSVs were deleted during cleanup)
+    files = teams.list_report_files(storage, only_latest=teams.ONLY_LATEST_FILE)
+    summary = _load_stage('rollups').load_summary_index(storage)
     
     if not files:
-        logging.warning(f"[{client_id}] No Excel reports found in container '{container_name}'. Notification skipped.")
+        logging.warning(f"[{client_id}] No reports found in container '{container_name}'. Notification skipped.")
         return
     
     # Send to Teams if webhook is configured
     if webhook_url:
         # Send Bilingual notifications
         for lang in ["es", "en"]:
-            success = send_to_teams_workflow(
+            success = teams.send_to_teams_workflow(
                 webhook_url=webhook_url,
                 container_url=container_url,
                 sas_token=sas_token,
@@ -111,9 +420,10 @@ def send_to_teams(client_id: str, container_name: str) -> None:
                 account_name=account_name,
                 container_name=container_name,
                 expiry_time=expiry_time,
-                expiry_hours=SAS_EXPIRY_HOURS,
+                expiry_hours=teams.SAS_EXPIRY_HOURS,
                 client_id=client_id,
-                language=lang
+                language=lang,
+                summary=summary
             )
             if not success:
                 logging.error(f"[{client_id}] Failed to send {lang.upper()} notification to Teams.")
@@ -0,0 +1,194 @@
+"""
+Declarative metric catalog.
+
+Maps Zabbix item key patterns to the unit, conversion factor and aggregation
+used in the report, and optionally to a rollup name (see rollups.py). A metric
+can feed a rollup as its complement (e.g. free % as used % = 100 - x), and only
+for hosts that lack a primary metric of that rollup.
+Patterns are either exact keys (`system.cpu.util`) or Zabbix-style wildcards
+(`vfs.fs.size[*,pused]`, `net.if.in[*]`).
+
+The catalog is compiled once per client into an exact-key dict plus a list of
+wildcard regexes; lookups are memoised per `key_`, so the per-value cost of
+conversion is a single multiplication regardless of how many metrics are
+configured.
+"""
+
+import json
+import os
+import re
+from collections import namedtuple
+
+# Named conversion factors usable from JSON catalogs
+NAMED_FACTORS = {
+    "bytes_to_gb": 1 / 1024**3,
+    "bytes_to_mb": 1 / 1024**2,
+    "bps_to_mbps": 1 / 1000**2,
+}
+
+# How the "Avg" column of a metric is reduced over the report window
+# - avg:  sample-weighted mean of all trend buckets / history values
+# - last: most recent value (gauges such as total memory or CPU count)
+AGGREGATIONS = ("avg", "last")
+
+# Default metrics collected when no catalog is configured for a client
+DEFAULT_CATALOG = [
+    {"key": "system.cpu.util", "unit": "%", "rollup": "cpu"},
+    {"key": "system.cpu.util[,idle]", "unit": "%"},
+    {"key": "system.cpu.util[,iowait]", "unit": "%"},
+    {"key": "system.cpu.util[,system]", "unit": "%"},
+    {"key": "system.cpu.util[,user]", "unit": "%"},
+    {"key": "system.cpu.util[,steal]", "unit": "%"},
+    {"key": "system.cpu.num", "unit": ""},
+    {"key": "vm.memory.utilization", "unit": "%", "rollup": "memory"},
+    {"key": "vm.memory.size[available]", "unit": "GB", "factor": "bytes_to_gb"},
+    {"key": "vm.memory.size[pavailable]", "unit": "%", "rollup": "memory", "rollup_complement": 100, "rollup_fallback": True},
+    {"key": "vm.memory.size[used]", "unit": "GB", "factor": "bytes_to_gb"},
+    {"key": "vm.memory.size[total]", "unit": "GB", "factor": "bytes_to_gb"},
+]
+
+MetricSpec = namedtuple(
+    "MetricSpec",
+    ["pattern", "unit", "factor", "aggregation", "rollup", "rollup_complement", "rollup_fallback"],
+    defaults=(None, False)
+)
+
+
+def _wildcard_to_regex(pattern):
+    """
+    Translates a Zabbix wildcard pattern into an anchored regex.
+    Only '*' is special; brackets and dots in item keys are literal.
+    """
+    return re.compile("^" + ".*".join(re.escape(part) for part in pattern.split("*")) + "$")
+
+
+def _parse_entry(entry):
+    """
+    Validates a single catalog entry and returns its MetricSpec.
+    """
+    if not isinstance(entry, dict) or not entry.get("key"):
+        raise ValueError(f"Invalid metric catalog entry (missing 'key'): {entry}")
+
+    factor = entry.get("factor", 1.0)
+    if isinstance(factor, str):
+        if factor not in NAMED_FACTORS:
+            raise ValueError(f"Unknown conversion factor '{factor}' for '{entry['key']}'")
+        factor = NAMED_FACTORS[factor]
+
+    aggregation = entry.get("aggregation", "avg")
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{aggregation}' for '{entry['key']}'")
+
+    complement = entry.get("rollup_complement")
+    if complement is not None:
+        complement = float(complement)
+
+    return MetricSpec(
+        entry["key"], entry.get("unit"), float(factor), aggregation, entry.get("rollup"),
+        complement, bool(entry.get("rollup_fallback", False))
+    )
+
+
+class MetricCatalog:
+    """
+    Compiled metric catalog with a memoised key_ -> MetricSpec lookup.
+    """
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.specs = [_parse_entry(e) for e in self.entries]
+        if not self.specs:
+            raise ValueError("Metric catalog is empty")
+
+        self._exact = {}
+        self._wildcards = []
+        for spec in self.specs:
+            if "*" in spec.pattern:
+                self._wildcards.append((_wildcard_to_regex(spec.pattern), spec))
+            else:
+                self._exact.setdefault(spec.pattern, spec)
+        self._cache = {}
+
+    @classmethod
+    def union(cls, catalogs):
+        """
+        Returns a catalog selecting every key selected by any of the given
+        catalogs. Used for shared discovery; per-client conversion still goes
+        through each client's own catalog.
+        """
+        return cls([entry for catalog in catalogs for entry in catalog.entries])
+
+    def resolve(self, item_key):
+        """
+        Returns the MetricSpec for an item key, or None if the key is not in the catalog.
+        Exact entries win over wildcards; wildcards are tried in catalog order.
+        """
+        try:
+            return self._cache[item_key]
+        except KeyError:
+            pass
+
+        spec = self._exact.get(item_key)
+        if spec is None:
+            for regex, candidate in self._wildcards:
+                if regex.match(item_key):
+                    spec = candidate
+                    break
+
+        self._cache[item_key] = spec
+        return spec
+
+    def item_get_params(self):
+        """
+        Returns the server-side key selection for item.get.
+
+        Exact-only catalogs use an indexed `filter`. As soon as a wildcard is
+        present, all patterns are sent as a prefix `search` (one request per
+        host instead of one per pattern); the few extra keys matched by the
+        prefix search are dropped client-side by `resolve`.
+        """
+        if not self._wildcards:
+            return {"filter": {"key_": list(self._exact)}}
+
+        return {
+            "search": {"key_": [spec.pattern for spec in self.specs]},
+            "searchWildcardsEnabled": True,
+            "searchByAny": True,
+            "startSearch": True,
+        }
+
+
+def _read_catalog_source(source):
+    """
+    Reads catalog entries from inline JSON or from a JSON file path.
+    Accepts either a list of entries or an object with a "metrics" list.
+    """
+    source = source.strip()
+    if source.startswith(("[", "{")):
+        data = json.loads(source)
+    else:
+        with open(source, encoding="utf-8") as f:
+            data = json.load(f)
+
+    if isinstance(data, dict):
+        data = data.get("metrics", [])
+    return data
+
+
+def load_catalog(client_id=None):
+    """
+    Loads the metric catalog for a client.
+
+    Lookup order: METRIC_CATALOG_{CLIENT}, METRIC_CATALOG, DEFAULT_CATALOG.
+    Each variable holds either inline JSON or a path to a JSON file.
+    """
+    source = None
+    if client_id:
+        source = os.getenv(f"METRIC_CATALOG_{client_id.upper()}")
+    if not source:
+        source = os.getenv("METRIC_CATALOG")
+
+    if not source:
+        return MetricCatalog(DEFAULT_CATALOG)
+
+    return MetricCatalog(_read_catalog_source(source))
@@ -0,0 +1,401 @@
+"""
+On-demand report generation for the HTTP trigger.
+
+Two cache layers live in the client's storage container:
+- `_cache/aggregates/<hostid>.json`: per-item daily trend partials
+  (min, max, sum, num, buckets, last clock, last avg), one blob per host.
+  Only complete UTC days (ended at least TREND_LAG_SECONDS ago) are kept, so a
+  new request only fetches the days it is missing plus the incomplete ones, and only reads the blobs of the hosts it covers.
+  Blobs are written with an ETag precondition; a concurrent update is merged
+  and retried once, then dropped (the days are refetched by a later request).
+- `_cache/reports/<key>_<created>.xlsx` plus `<key>.json`: rendered workbooks
+  keyed by (client, window, host group filter). A workbook younger than
+  REPORT_CACHE_TTL_SECONDS is served without contacting Zabbix. Workbooks are
+  kept for REPORT_RETENTION_HOURS, and download links never outlive them.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+AGGREGATES_PREFIX = "_cache/aggregates/"
+REPORTS_PREFIX = "_cache/reports/"
+
+# How long a rendered report is served before it is rebuilt (staleness)
+REPORT_CACHE_TTL_SECONDS = int(os.getenv("REPORT_CACHE_TTL_SECONDS", "3600"))
+# How long rendered report blobs are kept, and the longest link issued for them
+REPORT_RETENTION_SECONDS = max(int(os.getenv("REPORT_RETENTION_HOURS", "168")) * 3600, REPORT_CACHE_TTL_SECONDS)
+AGGREGATE_RETENTION_DAYS = int(os.getenv("AGGREGATE_RETENTION_DAYS", "62"))
+# Zabbix writes an hourly trend after the hour ends; a day is only complete
+# (and cached) once this long has passed after its end
+TREND_LAG_SECONDS = int(os.getenv("TREND_LAG_SECONDS", "3600"))
+MAX_REPORT_DAYS = AGGREGATE_RETENTION_DAYS
+
+# Parallel reads / writes of per-host aggregate blobs
+AGGREGATE_IO_WORKERS = int(os.getenv("AGGREGATE_IO_WORKERS", "8"))
+
+DAY_SECONDS = 86400
+
+# Index of each field in a daily partial
+P_MIN, P_MAX, P_SUM, P_NUM, P_BUCKETS, P_LAST_CLOCK, P_LAST_AVG = range(7)
+
+
+def report_cache_key(client_id, days, group_names):
+    """
+    Returns a stable cache key for a (client, window, group filter) combination.
+    """
+    raw = json.dumps([client_id.lower(), days, sorted(group_names or [])])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def get_cached_report(storage, cache_key, now):
+    """
+    Returns the metadata of a fresh rendered report, or None on miss/expiry.
+    """
+    try:
+        meta = json.loads(storage.get_text(f"{REPORTS_PREFIX}{cache_key}.json"))
+    except Exception:
+        return None
+
+    if now - meta.get("created", 0) > REPORT_CACHE_TTL_SECONDS:
+        return None
+    return meta
+
+
+def evict_expired_reports(storage, now):
+    """
+    Deletes rendered reports older than the retention period (not the TTL:
+    links handed out for a stale report stay valid until they expire).
+    Returns the number of evicted workbooks.
+    """
+    evicted = 0
+    for obj in storage.list(REPORTS_PREFIX):
+        if now - obj.last_modified.timestamp() <= REPORT_RETENTION_SECONDS:
+            continue
+        try:
+            storage.delete(obj.name)
+            evicted += obj.name.endswith(".xlsx")
+        except Exception as e:
+            print(f"[on-demand] Failed to evict {obj.name}: {e}")
+    return evicted
+
+
+def trends_to_partials(trends):
+    """
+    Reduces hourly trend buckets of one item into daily partials keyed by day start (as str).
+    """
+    partials = {}
+    for t in trends:
+        clock = int(t["clock"])
+        t_min = float(t["min"])
+        t_max = float(t["max"])
+        t_avg = float(t["avg"])
+        t_num = int(t["num"])
+        day = str(clock - clock % DAY_SECONDS)
+
+        p = partials.get(day)
+        if p is None:
+            partials[day] = [t_min, t_max, t_avg * t_num, t_num, 1, clock, t_avg]
+            continue
+        if t_min < p[P_MIN]:
+            p[P_MIN] = t_min
+        if t_max > p[P_MAX]:
+            p[P_MAX] = t_max
+        p[P_SUM] += t_avg * t_num
+        p[P_NUM] += t_num
+        p[P_BUCKETS] += 1
+        if clock >= p[P_LAST_CLOCK]:
+            p[P_LAST_CLOCK] = clock
+            p[P_LAST_AVG] = t_avg
+    return partials
+
+
+def merge_partials(day_partials, window_start, spec):
+    """
+    Merges the daily partials of one item from window_start onwards into
+    (min, max, avg, trend buckets, sample count) in report units, or None if
+    there is no data.
+    """
+    merged = None
+    for day, p in day_partials.items():
+        if p is None or int(day) < window_start:
+            continue
+        if merged is None:
+            merged = list(p)
+            continue
+        merged[P_MIN] = min(merged[P_MIN], p[P_MIN])
+        merged[P_MAX] = max(merged[P_MAX], p[P_MAX])
+        merged[P_SUM] += p[P_SUM]
+        merged[P_NUM] += p[P_NUM]
+        merged[P_BUCKETS] += p[P_BUCKETS]
+        if p[P_LAST_CLOCK] >= merged[P_LAST_CLOCK]:
+            merged[P_LAST_CLOCK] = p[P_LAST_CLOCK]
+            merged[P_LAST_AVG] = p[P_LAST_AVG]
+
+    if merged is None:
+        return None
+
+    if spec.aggregation == "last":
+        avg_raw = merged[P_LAST_AVG]
+    else:
+        avg_raw = merged[P_SUM] / merged[P_NUM] if merged[P_NUM] > 0 else 0
+
+    return merged[P_MIN] * spec.factor, merged[P_MAX] * spec.factor, avg_raw * spec.factor, merged[P_BUCKETS], merged[P_NUM]
+
+
+def _complete_days_end(now):
+    """
+    Returns the start of the first day whose trends may still be incomplete:
+    today, or yesterday during the first TREND_LAG_SECONDS after midnight.
+    """
+    settled = now - TREND_LAG_SECONDS
+    return settled - settled % DAY_SECONDS
+
+
+def _missing_ranges(cached, window_start, complete_end, today_start):
+    """
+    Returns the contiguous [start, end) ranges of days missing from an item's
+    cache, always ending with the range of incomplete days (complete_end to
+    the end of today).
+    """
+    ranges = []
+    run_start = None
+    for day in range(window_start, complete_end, DAY_SECONDS):
+        if str(day) in cached:
+            if run_start is not None:
+                ranges.append((run_start, day))
+                run_start = None
+        elif run_start is None:
+            run_start = day
+
+    if run_start is not None:
+        ranges.append((run_start, today_start + DAY_SECONDS))
+    else:
+        ranges.append((max(window_start, complete_end), today_start + DAY_SECONDS))
+    return tuple(ranges)
+
+
+def update_item_aggregates(zabbix_url, auth_token, items, aggregates, window_start, now):
+    """
+    Fetches only the missing trend ranges for the given items and merges them
+    into `aggregates` ({itemid: {day: partial}}). Incomplete days are always refetched.
+    Items missing the same ranges are fetched together, one trend.get per range.
+    Returns the number of trend.get requests issued.
+    """
+    from export_metrics_csv import get_trends
+
+    today_start = now - now % DAY_SECONDS
+    complete_end = _complete_days_end(now)
+
+    items_by_ranges = {}
+    for item, _ in items:
+        ranges = _missing_ranges(aggregates.get(item["itemid"], {}), window_start, complete_end, today_start)
+        items_by_ranges.setdefault(ranges, []).append(item["itemid"])
+
+    requests_issued = 0
+    for ranges, item_ids in items_by_ranges.items():
+        for range_start, range_end in ranges:
+            trends_by_item = get_trends(zabbix_url, auth_token, item_ids, range_start, min(range_end, now) - 1)
+            requests_issued += 1
+            for item_id in item_ids:
+                day_partials = aggregates.setdefault(item_id, {})
+                # Complete days without trends are recorded as None so they are not refetched
+                for day in range(range_start, min(range_end, complete_end), DAY_SECONDS):
+                    day_partials[str(day)] = None
+                day_partials.update(trends_to_partials(trends_by_item.get(item_id, [])))
+
+    return requests_issued
+
+
+def _prune_aggregates(aggregates, now):
+    """
+    Drops incomplete (see _complete_days_end) and expired days before the
+    aggregates are persisted.
+    """
+    today_start = now - now % DAY_SECONDS
+    complete_end = _complete_days_end(now)
+    oldest = today_start - AGGREGATE_RETENTION_DAYS * DAY_SECONDS
+    for item_id in list(aggregates):
+        day_partials = {
+            day: p for day, p in aggregates[item_id].items()
+            if oldest <= int(day) < complete_end
+        }
+        if day_partials:
+            aggregates[item_id] = day_partials
+        else:
+            del aggregates[item_id]
+
+
+def _dump_aggregates(aggregates):
+    # Canonical form, so an unchanged shard serializes to the stored text
+    return json.dumps(aggregates, separators=(",", ":"), sort_keys=True)
+
+
+def load_aggregate_shard(storage, host_id):
+    """
+    Returns (aggregates, etag, stored_text) of one host's aggregate blob;
+    ({}, None, None) if it does not exist yet.
+    """
+    data, etag = storage.get_versioned(f"{AGGREGATES_PREFIX}{host_id}.json")
+    if data is None:
+        return {}, None, None
+    text = data.decode("utf-8")
+    return json.loads(text), etag, text
+
+
+def save_aggregate_shard(storage, host_id, aggregates, etag, stored_text, now):
+    """
+    Prunes and writes one host's aggregates if they changed. On a concurrent
+    update the other writer's days are merged in and the write is retried once;
+    if that also fails the update is dropped. Returns True if the blob was written.
+    """
+    from storage import ConcurrentModificationError
+
+    name = f"{AGGREGATES_PREFIX}{host_id}.json"
+    _prune_aggregates(aggregates, now)
+    text = _dump_aggregates(aggregates)
+    if text == stored_text:
+        return False
+
+    try:
+        storage.put_if_match(name, text, etag)
+        return True
+    except ConcurrentModificationError:
+        pass
+
+    current, etag, _ = load_aggregate_shard(storage, host_id)
+    for item_id, day_partials in aggregates.items():
+        current.setdefault(item_id, {}).update(day_partials)
+    _prune_aggregates(current, now)
+    try:
+        storage.put_if_match(name, _dump_aggregates(current), etag)
+        return True
+    except ConcurrentModificationError:
+        print(f"[on-demand] Concurrent update of {name}, dropping this request's aggregates")
+        return False
+
+
+def build_on_demand_report(storage, client_id, credentials, catalog, days=30, group_names=None, group_filter=None):
+    """
+    Returns the metadata of a report for the last `days` days (whole UTC days
+    plus today so far), optionally limited to the given host groups:
+    {"blob", "etag", "created", "days", "groups", "hosts", "cached"}.
+    group_filter is the client's own host groups (ZABBIX_HOSTGROUPS_<CLIENT>);
+    other groups of its hosts are left out of the report.
+
+    Served from the rendered-report cache when fresh; otherwise rendered from
+    the per-item aggregate cache, fetching only missing ranges from Zabbix.
+    Only trends are used (no history fallback), to keep the request bounded.
+    """
+    now = int(time.time())
+    cache_key = report_cache_key(client_id, days, group_names)
+
+    meta = get_cached_report(storage, cache_key, now)
+    if meta is not None:
+        meta["cached"] = True
+        return meta
+
+    # Cache miss: only now pay for openpyxl and requests
+    from csv_to_excel_dashboard import build_workbook
+    from export_metrics_csv import get_catalog_items, get_hosts, visible_group_names, zabbix_login
+    from rollups import RollupBuilder
+
+    zabbix_url, zabbix_user, zabbix_password = credentials
+    auth_token = zabbix_login(zabbix_url, zabbix_user, zabbix_password)
+
+    hosts = get_hosts(zabbix_url, auth_token, group_names)
+    host_names = {h["hostid"]: h["host"] for h in hosts}
+    # Hosts on a shared server only show the client's own groups (group_filter)
+    host_to_groups = {
+        h["host"]: visible_group_names([g["name"] for g in h.get("groups", [])], group_filter)
+        for h in hosts
+    }
+    items = get_catalog_items(zabbix_url, auth_token, list(host_names), catalog) if hosts else []
+
+    # Only the aggregate blobs of the requested hosts are read
+    with ThreadPoolExecutor(max_workers=AGGREGATE_IO_WORKERS) as executor:
+        shards = dict(zip(host_names, executor.map(lambda h: load_aggregate_shard(storage, h), host_names)))
+    aggregates = {}
+    for shard, _, _ in shards.values():
+        aggregates.update(shard)
+
+    today_start = now - now % DAY_SECONDS
+    window_start = today_start - days * DAY_SECONDS
+    requests_issued = update_item_aggregates(zabbix_url, auth_token, items, aggregates, window_start, now) if items else 0
+    print(f"[on-demand] {client_id}: {len(items)} items, {requests_issued} trend.get request(s)")
+
+    host_rows = {}
+    rollups = RollupBuilder()
+    for item, spec in items:
+        stats = merge_partials(aggregates.get(item["itemid"], {}), window_start, spec)
+        if stats is None:
+            continue
+        min_val, max_val, avg_val, samples, sample_count = stats
+        host_name = host_names[item["hostid"]]
+        rollups.add_metric(host_name, host_to_groups[host_name], spec, min_val, max_val, avg_val, sample_count)
+        unit_label = spec.unit if spec.unit is not None else item.get("units", "")
+        host_rows.setdefault(host_name, []).append(
+            (item["name"], round(min_val, 2), round(max_val, 2), round(avg_val, 2), unit_label, samples)
+        )
+
+    for item, _ in items:
+        if item["itemid"] in aggregates:
+            shards[item["hostid"]][0][item["itemid"]] = aggregates[item["itemid"]]
+    with ThreadPoolExecutor(max_workers=AGGREGATE_IO_WORKERS) as executor:
+        written = sum(executor.map(
+            lambda h: save_aggregate_shard(storage, h, *shards[h], now),
+            shards
+        ))
+    print(f"[on-demand] {client_id}: {len(shards)} aggregate blob(s) read, {written} written")
+
+    workbook_bytes = build_workbook(host_rows, host_to_groups, period=f"Last {days} days", summary_index=rollups.build())
+
+    meta = {
+        # One blob per render: links to earlier renders keep their content
+        "blob": f"{REPORTS_PREFIX}{cache_key}_{now}.xlsx",
+        "etag": hashlib.sha256(workbook_bytes).hexdigest()[:32],
+        "created": now,
+        "days": days,
+        "groups": sorted(group_names or []),
+        "hosts": len(host_rows),
+    }
+    storage.put(meta["blob"], workbook_bytes)
+    storage.put(f"{REPORTS_PREFIX}{cache_key}.json", json.dumps(meta))
+
+    evicted = evict_expired_reports(storage, now)
+    if evicted:
+        print(f"[on-demand] {client_id}: evicted {evicted} expired report(s)")
+
+    meta["cached"] = False
+    return meta
+
+
+def report_link(storage, client_id, meta, expiry_hours, now=None):
+    """
+    Returns (url, expiry_time) for a rendered report: a read-only blob SAS URL
+    on Azure, or the file path on the local backend. The link expires after
+    expiry_hours, or earlier if the report is evicted before then.
+    """
+    if now is None:
+        now = time.time()
+    remaining_hours = (meta["created"] + REPORT_RETENTION_SECONDS - now) / 3600
+    expiry_hours = max(min(expiry_hours, remaining_hours), 0)
+
+    created = datetime.datetime.fromtimestamp(meta["created"], datetime.timezone.utc)
+    download_name = f"Zabbix_Report_{client_id}_{created.strftime('%Y%m%d_%H%M%S')}.xlsx"
+
+    if storage.kind != "azure":
+        return os.path.join(storage.path, *meta["blob"].split("/")), None
+
+    from send_to_teams import generate_blob_sas_url
+
+    return generate_blob_sas_url(
+        connection_string=storage.connection_string,
+        container_name=storage.container_name,
+        blob_name=meta["blob"],
+        expiry_hours=expiry_hours,
+        download_name=download_name
+    )
@@ -0,0 +1,166 @@
+"""
+Report output formats.
+
+Each client selects its outputs with REPORT_FORMATS_{CLIENT} (or REPORT_FORMATS),
+a comma-separated list of:
+- xlsx:         full Excel dashboard (per-group sections repeat host rows)
+- xlsx_compact: Excel with each row once plus a "Group Index" sheet
+- csv_gz:       gzip-compressed flat CSV data export
+- parquet:      compressed Parquet data export (requires pyarrow)
+- html:         static HTML summary
+"""
+
+import csv
+import gzip
+import html
+import importlib.util
+import io
+import os
+
+from csv_to_excel_dashboard import build_workbook, global_averages, group_membership
+from rollups import rollup_summary
+
+DEFAULT_REPORT_FORMATS = ["xlsx"]
+
+# Flat data export columns
+DATA_COLUMNS = ["Host", "Metric", "Min", "Max", "Avg", "Unit", "Samples", "Groups"]
+
+
+def _flat_rows(host_rows, host_to_groups):
+    for host_name, rows in host_rows.items():
+        groups_str = ";".join(host_to_groups.get(host_name, ["Unknown"]))
+        for metric, min_val, max_val, avg_val, unit, samples in rows:
+            yield [host_name, metric, min_val, max_val, avg_val, unit, samples, groups_str]
+
+
+def render_xlsx(host_rows, host_to_groups, period, summary_index=None):
+    return build_workbook(host_rows, host_to_groups, period, summary_index=summary_index)
+
+
+def render_xlsx_compact(host_rows, host_to_groups, period, summary_index=None):
+    return build_workbook(host_rows, host_to_groups, period, group_sections=False, summary_index=summary_index)
+
+
+def render_csv_gz(host_rows, host_to_groups, period, summary_index=None):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(DATA_COLUMNS)
+    writer.writerows(_flat_rows(host_rows, host_to_groups))
+    return gzip.compress(output.getvalue().encode("utf-8"), compresslevel=6)
+
+
+def render_parquet(host_rows, host_to_groups, period, summary_index=None):
+    import pandas as pd
+
+    df = pd.DataFrame(list(_flat_rows(host_rows, host_to_groups)), columns=DATA_COLUMNS)
+    output = io.BytesIO()
+    df.to_parquet(output, index=False, compression="gzip")
+    return output.getvalue()
+
+
+def render_html(host_rows, host_to_groups, period, summary_index=None):
+    """
+    Static, self-contained HTML summary: totals, global averages, host counts
+    per group and one line per host with its CPU / memory averages.
+    Averages come from the rollup index when available, otherwise from the rows.
+    """
+    def averages(rows, group=None, host=None):
+        summaries = [rollup_summary(summary_index, r, group=group, host=host) for r in ("cpu", "memory")]
+        if all(summaries):
+            return tuple(s.mean for s in summaries)
+        row_averages = global_averages(rows)
+        return tuple(s.mean if s else avg for s, avg in zip(summaries, row_averages))
+
+    cpu_avg, mem_avg = averages(host_rows)
+    groups = group_membership(host_rows, host_to_groups)
+    metric_count = sum(len(rows) for rows in host_rows.values())
+
+    def esc(value):
+        return html.escape(str(value))
+
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>",
+        "<title>Zabbix Monitoring Report</title>",
+        "<style>body{font-family:Segoe UI,Arial,sans-serif;margin:24px}"
+        "h1{color:#2E75B6}table{border-collapse:collapse;margin-bottom:24px}"
+        "th{background:#2E75B6;color:#fff}th,td{padding:4px 10px;border:1px solid #ddd}"
+        "td.n{text-align:right}</style></head><body>",
+        "<h1>ZABBIX MONITORING REPORT</h1>",
+        "<table>",
+        f"<tr><th>Total Hosts</th><td class='n'>{len(host_rows)}</td></tr>",
+        f"<tr><th>Total Metrics</th><td class='n'>{metric_count}</td></tr>",
+        f"<tr><th>Total Host Groups</th><td class='n'>{len(groups)}</td></tr>",
+        f"<tr><th>Period</th><td>{esc(period)}</td></tr>",
+        f"<tr><th>Global CPU Avg (%)</th><td class='n'>{cpu_avg:.2f}</td></tr>",
+        f"<tr><th>Global Memory Avg (%)</th><td class='n'>{mem_avg:.2f}</td></tr>",
+        "</table>",
+        "<h2>Host Groups</h2><table><tr><th>Group</th><th>Hosts</th><th>CPU Avg (%)</th><th>Memory Avg (%)</th></tr>",
+    ]
+    for group_name in sorted(groups):
+        group_cpu, group_mem = averages({h: host_rows[h] for h in groups[group_name]}, group=group_name)
+        parts.append(
+            f"<tr><td>{esc(group_name)}</td><td class='n'>{len(groups[group_name])}</td>"
+            f"<td class='n'>{group_cpu:.2f}</td><td class='n'>{group_mem:.2f}</td></tr>"
+        )
+    parts.append("</table>")
+
+    parts.append("<h2>Hosts</h2><table><tr><th>Host</th><th>Groups</th><th>CPU Avg (%)</th><th>Memory Avg (%)</th></tr>")
+    for host_name in sorted(host_rows):
+        host_cpu, host_mem = averages({host_name: host_rows[host_name]}, host=host_name)
+        groups_str = ", ".join(host_to_groups.get(host_name, ["Unknown"]))
+        parts.append(
+            f"<tr><td>{esc(host_name)}</td><td>{esc(groups_str)}</td>"
+            f"<td class='n'>{host_cpu:.2f}</td><td class='n'>{host_mem:.2f}</td></tr>"
+        )
+    parts.append("</table></body></html>")
+
+    return "".join(parts).encode("utf-8")
+
+
+# format name -> (filename suffix, renderer)
+REPORT_FORMATS = {
+    "xlsx": (".xlsx", render_xlsx),
+    "xlsx_compact": ("_compact.xlsx", render_xlsx_compact),
+    "csv_gz": (".csv.gz", render_csv_gz),
+    "parquet": (".parquet", render_parquet),
+    "html": (".html", render_html),
+}
+
+
+def get_report_formats(client_id=None):
+    """
+    Returns the output formats for a client: REPORT_FORMATS_{CLIENT}, then
+    REPORT_FORMATS, then DEFAULT_REPORT_FORMATS. Unknown names, and formats
+    whose optional dependency is not installed, raise ValueError.
+    """
+    value = None
+    if client_id:
+        value = os.getenv(f"REPORT_FORMATS_{client_id.upper()}")
+    if not value:
+        value = os.getenv("REPORT_FORMATS")
+    if not value:
+        return list(DEFAULT_REPORT_FORMATS)
+
+    formats = [f.strip().lower() for f in value.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in REPORT_FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown report format(s) {unknown}. Valid formats: {sorted(REPORT_FORMATS)}")
+    if "parquet" in formats and importlib.util.find_spec("pyarrow") is None:
+        raise ValueError("Report format 'parquet' requires pyarrow, which is not installed")
+    return formats
+
+
+def render_reports(host_rows, host_to_groups, formats, basename, period="Last 30 days", summary_index=None):
+    """
+    Renders every requested format. Returns a list of (filename, bytes).
+    summary_index is the optional rollup index (see rollups.py).
+    A format whose optional dependency is missing is skipped with a warning.
+    """
+    outputs = []
+    for fmt in formats:
+        suffix, renderer = REPORT_FORMATS[fmt]
+        try:
+            outputs.append((f"{basename}{suffix}", renderer(host_rows, host_to_groups, period, summary_index)))
+        except ImportError as e:
+            print(f"[WARNING] Skipping '{fmt}' output, missing dependency: {e}")
+    return outputs
@@ -0,0 +1,179 @@
+"""
+Sample-weighted rollups of metric aggregates per host, host group and client.
+
+Metrics are rolled up by the `rollup` name given in the metric catalog
+(e.g. "cpu", "memory"). Summaries are mergeable (min, max, weighted sum,
+sample count), built in one pass while metrics are exported, and stored as a
+compact JSON index (`_summary_index.json`) that the Dashboard, the HTML
+summary and the Teams notification read instead of re-scanning raw rows.
+
+Index layout:
+{
+  "generation_date": "...",
+  "rollups": {
+    "cpu": {
+      "client": [min, max, sum, count],
+      "groups": {group_name: [min, max, sum, count]},
+      "hosts": {host_name: [min, max, sum, count]},
+      "top_hosts": [[host_name, mean], ...],
+      "group_top_hosts": {group_name: [[host_name, mean], ...]}
+    }
+  }
+}
+"""
+
+import datetime
+import heapq
+import json
+import os
+
+SUMMARY_INDEX_BLOB = "_summary_index.json"
+
+# Number of hosts kept in the precomputed client and group top lists
+ROLLUP_TOP_N = int(os.getenv("ROLLUP_TOP_N", "10"))
+
+
+class Summary:
+    """
+    Mergeable min / max / sample-weighted mean / count.
+    """
+
+    __slots__ = ("min", "max", "sum", "count")
+
+    def __init__(self, min_val=float("inf"), max_val=float("-inf"), total=0.0, count=0):
+        self.min = min_val
+        self.max = max_val
+        self.sum = total
+        self.count = count
+
+    def add(self, min_val, max_val, mean, count):
+        """Adds one aggregated series (e.g. one item over the report window)."""
+        if min_val < self.min:
+            self.min = min_val
+        if max_val > self.max:
+            self.max = max_val
+        self.sum += mean * count
+        self.count += count
+
+    def merge(self, other):
+        if other.min < self.min:
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+        self.sum += other.sum
+        self.count += other.count
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else 0.0
+
+    def to_list(self):
+        return [round(self.min, 4), round(self.max, 4), round(self.sum, 4), self.count]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
+
+
+class RollupBuilder:
+    """
+    Collects per-item aggregates and builds the summary index.
+    Only host-level summaries are kept while adding; group and client
+    summaries are merged from them once in build().
+    """
+
+    def __init__(self):
+        self._hosts = {}        # rollup -> {host_name: Summary}
+        self._fallbacks = {}    # rollup -> {host_name: Summary}, used for hosts missing from _hosts
+        self._host_groups = {}  # host_name -> [group_name, ...]
+
+    def add(self, host_name, groups, rollup, min_val, max_val, mean, count, complement=None, fallback=False):
+        """
+        Adds one aggregated series. With `complement`, the series is rolled up
+        as (complement - value); with `fallback`, it only counts for hosts
+        without a non-fallback series of the same rollup.
+        """
+        if not rollup or count <= 0:
+            return
+        if complement is not None:
+            min_val, max_val, mean = complement - max_val, complement - min_val, complement - mean
+        self._host_groups[host_name] = groups
+        summaries = (self._fallbacks if fallback else self._hosts).setdefault(rollup, {})
+        host_summary = summaries.get(host_name)
+        if host_summary is None:
+            host_summary = summaries[host_name] = Summary()
+        host_summary.add(min_val, max_val, mean, count)
+
+    def add_metric(self, host_name, groups, spec, min_val, max_val, mean, count):
+        """Adds one aggregated series of a catalog metric (MetricSpec)."""
+        self.add(host_name, groups, spec.rollup, min_val, max_val, mean, count,
+                 complement=spec.rollup_complement, fallback=spec.rollup_fallback)
+
+    def build(self, top_n=ROLLUP_TOP_N):
+        def top(host_summaries):
+            best = heapq.nlargest(top_n, host_summaries, key=lambda kv: kv[1].mean)
+            return [[h, round(s.mean, 4)] for h, s in best]
+
+        rollups = {}
+        for rollup in sorted(set(self._hosts) | set(self._fallbacks)):
+            hosts = dict(self._fallbacks.get(rollup, {}))
+            hosts.update(self._hosts.get(rollup, {}))
+            client = Summary()
+            groups = {}
+            group_hosts = {}
+            for host_name, summary in hosts.items():
+                client.merge(summary)
+                for group in self._host_groups.get(host_name) or ["Unknown"]:
+                    groups.setdefault(group, Summary()).merge(summary)
+                    group_hosts.setdefault(group, []).append((host_name, summary))
+
+            rollups[rollup] = {
+                "client": client.to_list(),
+                "groups": {g: s.to_list() for g, s in groups.items()},
+                "hosts": {h: s.to_list() for h, s in hosts.items()},
+                "top_hosts": top(hosts.items()),
+                "group_top_hosts": {g: top(members) for g, members in group_hosts.items()},
+            }
+
+        return {
+            "generation_date": datetime.datetime.now().isoformat(),
+            "rollups": rollups,
+        }
+
+
+def load_summary_index(storage):
+    """
+    Returns the stored summary index, or None if it does not exist.
+    """
+    try:
+        return json.loads(storage.get_text(SUMMARY_INDEX_BLOB))
+    except Exception:
+        return None
+
+
+def rollup_summary(index, rollup, group=None, host=None):
+    """
+    Returns the Summary of a rollup for the client, a group or a host, or None.
+    """
+    data = (index or {}).get("rollups", {}).get(rollup)
+    if data is None:
+        return None
+    if host is not None:
+        values = data["hosts"].get(host)
+    elif group is not None:
+        values = data["groups"].get(group)
+    else:
+        values = data["client"]
+    return Summary.from_list(values) if values else None
+
+
+def top_hosts(index, rollup, n=ROLLUP_TOP_N, group=None):
+    """
+    Returns up to n (host_name, mean) pairs with the highest mean for the
+    client or for one group, from the lists precomputed at build time.
+    """
+    data = (index or {}).get("rollups", {}).get(rollup)
+    if data is None:
+        return []
+    pairs = data["top_hosts"] if group is None else data["group_top_hosts"].get(group, [])
+    return [tuple(pair) for pair in pairs[:n]]
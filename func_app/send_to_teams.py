@@ -3,11 +3,18 @@ Script to generate secure Azure Blob Storage container SAS tokens
 and send download links to Teams
 """
 
-from azure.storage.blob import BlobServiceClient, generate_container_sas as azure_generate_container_sas, ContainerSasPermissions
+from azure.storage.blob import (
+    BlobServiceClient,
+    BlobSasPermissions,
+    ContainerSasPermissions,
+    generate_blob_sas as azure_generate_blob_sas,
+    generate_container_sas as azure_generate_container_sas,
+)
 from datetime import datetime, timedelta, timezone
 import os
 import requests
 import json
+from rollups import rollup_summary, top_hosts
 
 # Configuration from environment variables (Azure Functions)
 TEAMS_WEBHOOK_URL = os.getenv('TEAMS_WEBHOOK_URL', '')
@@ -15,6 +22,20 @@ SAS_EXPIRY_HOURS = int(os.getenv('SAS_EXPIRY_HOURS', '168'))  # Token valid for
 ONLY_LATEST_FILE = os.getenv('ONLY_LATEST_FILE', 'true').lower() == 'true'  # Show only the latest Excel file
 
 
+def _parse_connection_string(connection_string: str) -> tuple:
+    """
+    Extracts (account_name, account_key) from a storage connection string.
+    """
+    conn_parts = dict(item.split('=', 1) for item in connection_string.split(';') if '=' in item)
+    account_name = conn_parts.get('AccountName')
+    account_key = conn_parts.get('AccountKey')
+    
+    if not account_name or not account_key:
+        raise ValueError("Invalid connection string: missing AccountName or AccountKey")
+    
+    return account_name, account_key
+
+
 def generate_container_sas(
     connection_string: str,
     container_name: str,
@@ -25,12 +46,7 @@ def generate_container_sas(
     """
     
     # Extract information from connection string
-    conn_parts = dict(item.split('=', 1) for item in connection_string.split(';') if '=' in item)
-    account_name = conn_parts.get('AccountName')
-    account_key = conn_parts.get('AccountKey')
-    
-    if not account_name or not account_key:
-        raise ValueError("Invalid connection string: missing AccountName or AccountKey")
+    account_name, account_key = _parse_connection_string(connection_string)
     
     # Create client to verify container exists
     blob_service_client = BlobServiceClient.from_connection_string(connection_string)
@@ -60,37 +76,147 @@ def generate_container_sas(
     return container_url, sas_token, expiry_time, account_name
 
 
-def list_container_files(connection_string: str, container_name: str, only_latest: bool = False) -> list:
+def generate_blob_sas_url(
+    connection_string: str,
+    container_name: str,
+    blob_name: str,
+    expiry_hours: int = 168,
+    download_name: str = None
+) -> tuple:
     """
-    Lists Excel files in the container.
+    Generates a read-only SAS download URL for a single blob.
+    The token is signed locally (no storage round trip).
     """
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
+    account_name, account_key = _parse_connection_string(connection_string)
+    expiry_time = datetime.now(timezone.utc) + timedelta(hours=expiry_hours)
     
-    excel_files = []
-    blob_list = container_client.list_blobs()
+    sas_token = azure_generate_blob_sas(
+        account_name=account_name,
+        container_name=container_name,
+        blob_name=blob_name,
+        account_key=account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=expiry_time,
+        content_disposition=f'attachment; filename="{download_name}"' if download_name else None
+    )
     
-    # Collect Excel files with their last modified time
-    excel_blobs = []
-    for blob in blob_list:
-        if blob.name.lower().endswith(('.xlsx', '.xls')):
-            excel_blobs.append({
+    blob_url = f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}"
+    return blob_url, expiry_time
+
+
+# Report file extensions listed in notifications
+REPORT_EXTENSIONS = ('.xlsx', '.xls', '.csv.gz', '.parquet', '.html')
+
+# Download link labels per report file type
+LINK_LABELS = {
+    'en': [
+        ('_compact.xlsx', 'Download Compact Excel File'),
+        ('.xlsx', 'Download Excel File'),
+        ('.xls', 'Download Excel File'),
+        ('.csv.gz', 'Download Data (CSV, gzip)'),
+        ('.parquet', 'Download Data (Parquet)'),
+        ('.html', 'Open HTML Summary'),
+    ],
+    'es': [
+        ('_compact.xlsx', 'Descargar archivo Excel compacto'),
+        ('.xlsx', 'Descargar archivo Excel'),
+        ('.xls', 'Descargar archivo Excel'),
+        ('.csv.gz', 'Descargar datos (CSV, gzip)'),
+        ('.parquet', 'Descargar datos (Parquet)'),
+        ('.html', 'Abrir resumen HTML'),
+    ],
+}
+
+
+def _report_run_id(name: str) -> str:
+    """
+    Returns the run prefix shared by all outputs of one report run
+    (e.g. 'Zabbix_Report_20250101_000000').
+    """
+    base = name.lower()
+    for ext in sorted(REPORT_EXTENSIONS + ('_compact.xlsx',), key=len, reverse=True):
+        if base.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _link_label(file: str, language: str) -> str:
+    for suffix, label in LINK_LABELS.get(language, LINK_LABELS['en']):
+        if file.lower().endswith(suffix):
+            return label
+    return "Descargar" if language == "es" else "Download"
+
+
+def list_report_files(storage, only_latest: bool = False) -> list:
+    """
+    Lists report files in the client's storage container.
+    With only_latest, returns every output of the most recent report run.
+    Internal objects (names starting with '_', e.g. caches) are ignored.
+    """
+    # Collect report files with their last modified time
+    report_blobs = []
+    for blob in storage.list():
+        if blob.name.startswith('_'):
+            continue
+        if blob.name.lower().endswith(REPORT_EXTENSIONS):
+            report_blobs.append({
                 'name': blob.name,
                 'last_modified': blob.last_modified
             })
     
-    if not excel_blobs:
+    if not report_blobs:
         return []
     
+    # Sort by last_modified (newest first)
+    sorted_blobs = sorted(report_blobs, key=lambda x: x['last_modified'], reverse=True)
+    
     if only_latest:
-        # Sort by last_modified and return only the most recent
-        latest_blob = sorted(excel_blobs, key=lambda x: x['last_modified'], reverse=True)[0]
-        return [latest_blob['name']]
+        latest_run = _report_run_id(sorted_blobs[0]['name'])
+        return sorted(blob['name'] for blob in sorted_blobs if _report_run_id(blob['name']) == latest_run)
     else:
-        # Return all files sorted by last_modified (newest first)
-        sorted_blobs = sorted(excel_blobs, key=lambda x: x['last_modified'], reverse=True)
         return [blob['name'] for blob in sorted_blobs]
 
+def _summary_payload(summary: dict, top_n: int = 3) -> dict:
+    """
+    Compact client-level figures from the rollup index, for the Workflow payload.
+    """
+    payload = {}
+    for rollup in ("cpu", "memory"):
+        client_summary = rollup_summary(summary, rollup)
+        if client_summary is None:
+            continue
+        payload[rollup] = {
+            "avg": round(client_summary.mean, 2),
+            "max": round(client_summary.max, 2),
+            "top_hosts": [[h, round(v, 2)] for h, v in top_hosts(summary, rollup, top_n)],
+        }
+    return payload
+
+
+def _summary_text(summary: dict, language: str) -> str:
+    """
+    Markdown overview (global CPU / memory and top CPU hosts) for the message body.
+    """
+    figures = _summary_payload(summary)
+    if not figures:
+        return ""
+
+    labels = {
+        "en": ("Summary", "CPU", "Memory", "avg", "max", "Top CPU hosts"),
+        "es": ("Resumen", "CPU", "Memoria", "media", "máx", "Hosts con más CPU"),
+    }.get(language, ("Summary", "CPU", "Memory", "avg", "max", "Top CPU hosts"))
+    title, cpu_label, mem_label, avg_label, max_label, top_label = labels
+
+    text = f"**{title}:**\n"
+    for rollup, label in (("cpu", cpu_label), ("memory", mem_label)):
+        if rollup in figures:
+            text += f"- {label}: {avg_label} {figures[rollup]['avg']:.2f}% / {max_label} {figures[rollup]['max']:.2f}%\n"
+    if figures.get("cpu", {}).get("top_hosts"):
+        hosts = ", ".join(f"{h} ({v:.2f}%)" for h, v in figures["cpu"]["top_hosts"])
+        text += f"- {top_label}: {hosts}\n"
+    return text + "\n"
+
+
 def send_to_teams_workflow(
     webhook_url: str,
     container_url: str,
@@ -101,10 +227,12 @@ def send_to_teams_workflow(
     expiry_time: datetime,
     expiry_hours: int,
     client_id: str,
-    language: str = "es"
+    language: str = "es",
+    summary: dict = None
 ) -> bool:
     """
     Sends download links to Teams via Workflow.
+    summary is the optional rollup index (see rollups.py), rendered as a short overview.
     """
     
     if not webhook_url:
@@ -114,6 +242,8 @@ def send_to_teams_workflow(
     generation_date = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
     expiry_str = expiry_time.strftime('%Y-%m-%d %H:%M:%S')
     
+    summary_text = _summary_text(summary, language)
+    
     # Build message text based on language
     if language == "en":
         # English message
@@ -123,7 +253,7 @@ def send_to_teams_workflow(
             for i, file in enumerate(files, 1):
                 file_url = f"{container_url}/{file}?{sas_token}"
                 files_text += f"{i}. **{file}**  \n"
-                files_text += f"   [Download Excel File]({file_url})\n\n"
+                files_text += f"   [{_link_label(file, language)}]({file_url})\n\n"
         
         full_message = f"""**📊 Zabbix Monitoring Report ({client_id.upper()}) - Ready for Download**
 
@@ -133,12 +263,12 @@ def send_to_teams_workflow(
 - Link expires: {expiry_str} UTC
 - Validity: {expiry_hours} hours
 
-{files_text}
+{summary_text}{files_text}
 
 **How to download:**
-1. Click on any "Download Excel File" link above
+1. Click on any link above
 2. The file will download automatically
-3. Open it in Microsoft Excel to view all charts and data
+3. Open Excel files in Microsoft Excel to view all charts and data
 
 **Important:** Download links expire in {expiry_hours} hours
 """
@@ -150,7 +280,7 @@ def send_to_teams_workflow(
             for i, file in enumerate(files, 1):
                 file_url = f"{container_url}/{file}?{sas_token}"
                 files_text += f"{i}. **{file}**  \n"
-                files_text += f"   [Descargar archivo Excel]({file_url})\n\n"
+                files_text += f"   [{_link_label(file, language)}]({file_url})\n\n"
         
         full_message = f"""**📊 Informe de Monitorización Zabbix ({client_id.upper()}) - Listo para Descargar**
 
@@ -160,12 +290,12 @@ def send_to_teams_workflow(
 - Enlaces expiran: {expiry_str} UTC
 - Validez: {expiry_hours} horas
 
-{files_text}
+{summary_text}{files_text}
 
 **Cómo descargar:**
-1. Haz clic en cualquier enlace "Descargar archivo Excel" de arriba
+1. Haz clic en cualquier enlace de arriba
 2. El archivo se descargará automáticamente
-3. Ábrelo en Microsoft Excel para ver todos los gráficos y datos
+3. Abre los archivos Excel en Microsoft Excel para ver todos los gráficos y datos
 
 **Importante:** Los enlaces de descarga expiran en {expiry_hours} horas
 """
@@ -182,7 +312,8 @@ def send_to_teams_workflow(
         "sas_token": sas_token,
         "archivos": files,
         "full_message": full_message,
-        "language": language
+        "language": language,
+        "resumen": _summary_payload(summary)
     }
     
     try:
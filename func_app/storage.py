@@ -0,0 +1,323 @@
+"""
+Storage backends for pipeline artifacts (per-host CSVs, metadata JSON, reports).
+
+- AzureBlobStorage: one blob container per client (production).
+- LocalStorage: one directory per client, for backfills, reprocessing of
+  archived data and profiling runs without an Azure storage account.
+
+The backend is selected with STORAGE_BACKEND ("azure" by default, or "local").
+"""
+
+import datetime
+import io
+import mmap
+import os
+import tempfile
+from collections import namedtuple
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure").lower()
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT", "local_storage")
+
+# Local files at least this large are read through a memory map
+MMAP_THRESHOLD_BYTES = int(os.getenv("MMAP_THRESHOLD_BYTES", str(8 * 1024 * 1024)))
+
+StoredObject = namedtuple("StoredObject", ["name", "last_modified", "size"])
+
+# Content types set on uploaded blobs, by name suffix (first match wins),
+# so browsers open HTML reports instead of downloading them
+CONTENT_TYPES = [
+    (".html", "text/html; charset=utf-8"),
+    (".csv.gz", "application/gzip"),
+    (".csv", "text/csv; charset=utf-8"),
+    (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    (".parquet", "application/vnd.apache.parquet"),
+    (".json", "application/json"),
+]
+
+
+def content_type_for(name):
+    """Returns the content type for an object name, or None if unknown."""
+    for suffix, content_type in CONTENT_TYPES:
+        if name.endswith(suffix):
+            return content_type
+    return None
+
+
+class ConcurrentModificationError(Exception):
+    """Raised by put_if_match when the object changed since it was read."""
+
+
+class StorageBackend:
+    """
+    Minimal object store interface used by the pipeline stages.
+    Names are '/'-separated paths relative to the client container.
+    """
+
+    kind = None
+
+    def __init__(self, container_name):
+        self.container_name = container_name
+
+    def ensure_container(self) -> bool:
+        """Creates the container if missing. Returns True if it was created."""
+        raise NotImplementedError
+
+    def put(self, name, data) -> None:
+        """Writes (overwrites) an object. `data` may be str or bytes."""
+        raise NotImplementedError
+
+    def get(self, name) -> bytes:
+        """Returns the full content of an object."""
+        raise NotImplementedError
+
+    def get_text(self, name, encoding="utf-8") -> str:
+        return self.get(name).decode(encoding)
+
+    def get_versioned(self, name) -> tuple:
+        """Returns (content, etag), or (None, None) if the object does not exist."""
+        raise NotImplementedError
+
+    def put_if_match(self, name, data, etag) -> None:
+        """
+        Writes an object only if it is unchanged since it was read with
+        get_versioned (etag None: only if it does not exist yet).
+        Raises ConcurrentModificationError otherwise.
+        """
+        raise NotImplementedError
+
+    def stream(self, name):
+        """Returns a readable binary file-like object for an object."""
+        raise NotImplementedError
+
+    def list(self, prefix="") -> list:
+        """Lists objects as StoredObject(name, last_modified, size)."""
+        raise NotImplementedError
+
+    def delete(self, name) -> None:
+        raise NotImplementedError
+
+    def exists(self, name) -> bool:
+        raise NotImplementedError
+
+
+class AzureBlobStorage(StorageBackend):
+    """
+    Azure Blob Storage backend bound to a single container.
+    """
+
+    kind = "azure"
+
+    def __init__(self, connection_string, container_name):
+        super().__init__(container_name)
+        # Imported here so local runs do not need (or pay for) the Azure SDK
+        from azure.storage.blob import BlobServiceClient
+
+        self.connection_string = connection_string
+        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+        self.container_client = blob_service_client.get_container_client(container_name)
+
+    def ensure_container(self) -> bool:
+        if self.container_client.exists():
+            return False
+        self.container_client.create_container()
+        return True
+
+    def _content_settings(self, name):
+        from azure.storage.blob import ContentSettings
+
+        content_type = content_type_for(name)
+        return ContentSettings(content_type=content_type) if content_type else None
+
+    def put(self, name, data) -> None:
+        self.container_client.get_blob_client(name).upload_blob(
+            data, overwrite=True, content_settings=self._content_settings(name)
+        )
+
+    def get(self, name) -> bytes:
+        return self.container_client.get_blob_client(name).download_blob().readall()
+
+    def get_versioned(self, name) -> tuple:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            downloader = self.container_client.get_blob_client(name).download_blob()
+        except ResourceNotFoundError:
+            return None, None
+        return downloader.readall(), downloader.properties.etag
+
+    def put_if_match(self, name, data, etag) -> None:
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+        blob_client = self.container_client.get_blob_client(name)
+        try:
+            if etag is None:
+                blob_client.upload_blob(data, overwrite=False, content_settings=self._content_settings(name))
+            else:
+                blob_client.upload_blob(
+                    data, overwrite=True, content_settings=self._content_settings(name),
+                    etag=etag, match_condition=MatchConditions.IfNotModified
+                )
+        except (ResourceExistsError, ResourceModifiedError) as e:
+            raise ConcurrentModificationError(name) from e
+
+    def stream(self, name):
+        return io.BytesIO(self.get(name))
+
+    def list(self, prefix="") -> list:
+        return [
+            StoredObject(blob.name, blob.last_modified, blob.size)
+            for blob in self.container_client.list_blobs(name_starts_with=prefix or None)
+        ]
+
+    def delete(self, name) -> None:
+        self.container_client.delete_blob(name)
+
+    def exists(self, name) -> bool:
+        return self.container_client.get_blob_client(name).exists()
+
+
+class _MappedReader(io.RawIOBase):
+    """
+    Read-only file-like view over a memory-mapped file.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._mm.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._mm.seek(offset, whence)
+        return self._mm.tell()
+
+    def tell(self):
+        return self._mm.tell()
+
+    def close(self):
+        if not self.closed:
+            self._mm.close()
+            self._file.close()
+        super().close()
+
+
+class LocalStorage(StorageBackend):
+    """
+    Local-directory backend: `<root>/<container_name>/<name>`.
+    Writes are atomic (temporary file + rename); large reads are memory-mapped.
+    """
+
+    kind = "local"
+
+    def __init__(self, root, container_name):
+        super().__init__(container_name)
+        self.path = os.path.abspath(os.path.join(root, container_name))
+
+    def _resolve(self, name):
+        path = os.path.abspath(os.path.join(self.path, *name.split("/")))
+        if not path.startswith(self.path + os.sep):
+            raise ValueError(f"Invalid object name '{name}'")
+        return path
+
+    def ensure_container(self) -> bool:
+        if os.path.isdir(self.path):
+            return False
+        os.makedirs(self.path, exist_ok=True)
+        return True
+
+    def put(self, name, data) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        path = self._resolve(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, name) -> bytes:
+        with self.stream(name) as f:
+            return f.read()
+
+    def _etag(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
+    def get_versioned(self, name) -> tuple:
+        path = self._resolve(name)
+        etag = self._etag(path)
+        if etag is None:
+            return None, None
+        return self.get(name), etag
+
+    def put_if_match(self, name, data, etag) -> None:
+        # Best effort: the check and the rename are not atomic across processes
+        if self._etag(self._resolve(name)) != etag:
+            raise ConcurrentModificationError(name)
+        self.put(name, data)
+
+    def stream(self, name):
+        path = self._resolve(name)
+        size = os.path.getsize(path)
+        # Empty files cannot be memory-mapped
+        if size and size >= MMAP_THRESHOLD_BYTES:
+            return io.BufferedReader(_MappedReader(path))
+        return open(path, "rb")
+
+    def list(self, prefix="") -> list:
+        objects = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith(".part"):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                name = os.path.relpath(full_path, self.path).replace(os.sep, "/")
+                if not name.startswith(prefix):
+                    continue
+                st = os.stat(full_path)
+                objects.append(StoredObject(
+                    name,
+                    datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc),
+                    st.st_size
+                ))
+        return objects
+
+    def delete(self, name) -> None:
+        os.remove(self._resolve(name))
+
+    def exists(self, name) -> bool:
+        return os.path.isfile(self._resolve(name))
+
+
+def get_storage(container_name) -> StorageBackend:
+    """
+    Returns the configured storage backend for a client container.
+    """
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(LOCAL_STORAGE_ROOT, container_name)
+
+    if STORAGE_BACKEND != "azure":
+        raise ValueError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}' (expected 'azure' or 'local')")
+
+    connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+    if not connect_str:
+        raise ValueError("AZURE_STORAGE_CONNECTION_STRING is not configured")
+    return AzureBlobStorage(connect_str, container_name)
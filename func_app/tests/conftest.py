@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# Pipeline modules are imported flat, as the Functions host does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import LocalStorage  # noqa: E402
+
+
+@pytest.fixture
+def local(tmp_path):
+    """LocalStorage container for a client "acme" in a temporary directory."""
+    store = LocalStorage(str(tmp_path), "metrics-acme")
+    store.ensure_container()
+    return store
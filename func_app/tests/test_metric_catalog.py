@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from metric_catalog import DEFAULT_CATALOG, NAMED_FACTORS, MetricCatalog, load_catalog
+
+
+def test_exact_key_beats_wildcard():
+    catalog = MetricCatalog([
+        {"key": "vfs.fs.size[*,pused]", "unit": "%"},
+        {"key": "vfs.fs.size[/,pused]", "unit": "pct"},
+    ])
+    assert catalog.resolve("vfs.fs.size[/,pused]").unit == "pct"
+    assert catalog.resolve("vfs.fs.size[/data,pused]").unit == "%"
+
+
+def test_wildcards_match_in_catalog_order():
+    catalog = MetricCatalog([
+        {"key": "net.if.in[eth*]", "unit": "eth"},
+        {"key": "net.if.in[*]", "unit": "any"},
+    ])
+    assert catalog.resolve("net.if.in[eth0]").unit == "eth"
+    assert catalog.resolve("net.if.in[lo]").unit == "any"
+
+
+def test_wildcard_treats_brackets_and_dots_literally():
+    catalog = MetricCatalog([{"key": "vfs.fs.size[*,pused]"}])
+    assert catalog.resolve("vfs.fs.size[/,pused]") is not None
+    assert catalog.resolve("vfsXfs.size[/,pused]") is None
+    assert catalog.resolve("vfs.fs.size[/,pused]x") is None
+
+
+def test_unknown_key_is_memoised_as_none():
+    catalog = MetricCatalog([{"key": "system.cpu.util"}])
+    assert catalog.resolve("agent.ping") is None
+    assert catalog._cache == {"agent.ping": None}
+
+
+def test_named_factor_and_defaults():
+    spec = MetricCatalog([{"key": "vm.memory.size[total]", "factor": "bytes_to_gb"}]).resolve("vm.memory.size[total]")
+    assert spec.factor == NAMED_FACTORS["bytes_to_gb"]
+    assert spec.aggregation == "avg"
+    assert spec.unit is None
+    assert spec.rollup is None
+
+
+@pytest.mark.parametrize("entries", [
+    [],
+    [{"unit": "%"}],
+    [{"key": "a", "factor": "furlongs"}],
+    [{"key": "a", "aggregation": "median"}],
+])
+def test_invalid_catalogs_raise(entries):
+    with pytest.raises(ValueError):
+        MetricCatalog(entries)
+
+
+def test_item_get_params_uses_filter_without_wildcards():
+    catalog = MetricCatalog(DEFAULT_CATALOG)
+    assert catalog.item_get_params() == {"filter": {"key_": [e["key"] for e in DEFAULT_CATALOG]}}
+
+
+def test_item_get_params_uses_prefix_search_with_wildcards():
+    params = MetricCatalog([{"key": "system.cpu.util"}, {"key": "net.if.in[*]"}]).item_get_params()
+    assert params["search"] == {"key_": ["system.cpu.util", "net.if.in[*]"]}
+    assert params["searchWildcardsEnabled"] and params["searchByAny"] and params["startSearch"]
+
+
+def test_union_selects_keys_of_every_catalog():
+    union = MetricCatalog.union([
+        MetricCatalog([{"key": "system.cpu.util"}]),
+        MetricCatalog([{"key": "net.if.in[*]"}]),
+    ])
+    assert union.resolve("system.cpu.util") is not None
+    assert union.resolve("net.if.in[eth0]") is not None
+
+
+def test_load_catalog_lookup_order(monkeypatch, tmp_path):
+    path = tmp_path / "catalog.json"
+    path.write_text(json.dumps({"metrics": [{"key": "from.file"}]}))
+    monkeypatch.setenv("METRIC_CATALOG", str(path))
+    monkeypatch.setenv("METRIC_CATALOG_ACME", '[{"key": "inline.key"}]')
+
+    assert [s.pattern for s in load_catalog("acme").specs] == ["inline.key"]
+    assert [s.pattern for s in load_catalog("other").specs] == ["from.file"]
+
+    monkeypatch.delenv("METRIC_CATALOG")
+    assert len(load_catalog("other").specs) == len(DEFAULT_CATALOG)
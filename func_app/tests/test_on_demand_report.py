@@ -0,0 +1,183 @@
+import datetime
+import json
+import sys
+import types
+
+import pytest
+
+import on_demand_report as odr
+from metric_catalog import MetricSpec
+from on_demand_report import (
+    DAY_SECONDS,
+    _complete_days_end,
+    _missing_ranges,
+    _prune_aggregates,
+    load_aggregate_shard,
+    merge_partials,
+    report_cache_key,
+    save_aggregate_shard,
+    trends_to_partials,
+)
+
+AVG = MetricSpec("k", "%", 1.0, "avg", None)
+LAST = MetricSpec("k", "%", 1.0, "last", None)
+
+TODAY = 100 * DAY_SECONDS
+NOW = TODAY + 3600
+
+
+def trend(clock, min_val, max_val, avg, num):
+    return {"clock": str(clock), "min": str(min_val), "max": str(max_val), "avg": str(avg), "num": str(num)}
+
+
+def test_missing_ranges_empty_cache_is_one_range_through_today():
+    assert _missing_ranges({}, TODAY - 3 * DAY_SECONDS, TODAY, TODAY) == ((TODAY - 3 * DAY_SECONDS, TODAY + DAY_SECONDS),)
+
+
+def test_missing_ranges_empty_window_still_fetches_today():
+    assert _missing_ranges({}, TODAY, TODAY, TODAY) == ((TODAY, TODAY + DAY_SECONDS),)
+
+
+def test_missing_ranges_refetch_yesterday_within_trend_lag():
+    yesterday = TODAY - DAY_SECONDS
+    cached = {str(yesterday - DAY_SECONDS): None}
+    assert _missing_ranges(cached, yesterday - DAY_SECONDS, yesterday, TODAY) == ((yesterday, TODAY + DAY_SECONDS),)
+
+
+def test_complete_days_end_waits_for_trend_lag(monkeypatch):
+    monkeypatch.setattr(odr, "TREND_LAG_SECONDS", 3600)
+    assert _complete_days_end(TODAY + 600) == TODAY - DAY_SECONDS
+    assert _complete_days_end(TODAY + 3600) == TODAY
+
+
+def test_missing_ranges_skips_cached_days_including_none():
+    d = [TODAY - i * DAY_SECONDS for i in range(4, 0, -1)]  # 4 days before today
+    cached = {str(d[1]): None, str(d[3]): [1, 1, 1, 1, 1, d[3], 1]}
+    assert _missing_ranges(cached, d[0], TODAY, TODAY) == (
+        (d[0], d[1]),
+        (d[2], d[3]),
+        (TODAY, TODAY + DAY_SECONDS),
+    )
+
+
+def test_trends_to_partials_splits_days_and_weights_by_samples():
+    day = TODAY - DAY_SECONDS
+    partials = trends_to_partials([
+        trend(day, 1, 5, 2, 10),
+        trend(day + 3600, 0, 9, 4, 30),
+        trend(TODAY, 3, 3, 3, 1),
+    ])
+    assert partials[str(day)] == [0.0, 9.0, 140.0, 40, 2, day + 3600, 4.0]
+    assert partials[str(TODAY)] == [3.0, 3.0, 3.0, 1, 1, TODAY, 3.0]
+
+
+def test_merge_partials_skips_none_days_and_days_before_window():
+    day = TODAY - DAY_SECONDS
+    partials = {
+        str(day - DAY_SECONDS): [0.0, 100.0, 1000.0, 10, 1, day - 1, 100.0],
+        str(day): None,
+        str(TODAY): [2.0, 6.0, 40.0, 10, 2, TODAY + 60, 5.0],
+    }
+    assert merge_partials(partials, day, AVG) == (2.0, 6.0, 4.0, 2, 10)
+    assert merge_partials(partials, day, LAST)[2] == 5.0
+
+
+def test_merge_partials_without_data_is_none():
+    assert merge_partials({}, 0, AVG) is None
+    assert merge_partials({str(TODAY): None}, 0, AVG) is None
+
+
+def test_merge_partials_applies_factor():
+    spec = MetricSpec("k", "GB", 0.5, "avg", None)
+    assert merge_partials({str(TODAY): [2.0, 4.0, 30.0, 10, 1, TODAY, 3.0]}, 0, spec) == (1.0, 2.0, 1.5, 1, 10)
+
+
+def test_prune_drops_today_expired_days_and_empty_items():
+    expired = TODAY - (odr.AGGREGATE_RETENTION_DAYS + 1) * DAY_SECONDS
+    kept = TODAY - DAY_SECONDS
+    aggregates = {
+        "1": {str(expired): None, str(kept): None, str(TODAY): [1, 1, 1, 1, 1, TODAY, 1]},
+        "2": {str(TODAY): [1, 1, 1, 1, 1, TODAY, 1]},
+    }
+    _prune_aggregates(aggregates, NOW)
+    assert aggregates == {"1": {str(kept): None}}
+
+
+def test_days_within_trend_lag_are_not_cached(monkeypatch):
+    monkeypatch.setattr(odr, "TREND_LAG_SECONDS", 3600)
+    two_days_ago, yesterday = TODAY - 2 * DAY_SECONDS, TODAY - DAY_SECONDS
+    requested = []
+
+    def fake_get_trends(url, auth, item_ids, time_from, time_till):
+        requested.append((time_from, time_till))
+        return {"1": [trend(two_days_ago, 1, 1, 1, 1)]}
+
+    monkeypatch.setitem(sys.modules, "export_metrics_csv", types.SimpleNamespace(get_trends=fake_get_trends))
+    aggregates = {}
+    now = TODAY + 600  # yesterday's 23:00 trend may not be written yet
+
+    odr.update_item_aggregates("url", "token", [({"itemid": "1"}, AVG)], aggregates, two_days_ago, now)
+    _prune_aggregates(aggregates, now)
+
+    assert requested == [(two_days_ago, now - 1)]
+    assert list(aggregates["1"]) == [str(two_days_ago)]
+
+
+def test_report_cache_key_ignores_case_and_group_order():
+    assert report_cache_key("Acme", 30, ["b", "a"]) == report_cache_key("acme", 30, ["a", "b"])
+    assert report_cache_key("acme", 30, None) != report_cache_key("acme", 14, None)
+
+
+def test_aggregate_shard_is_only_written_when_changed(local):
+    day = str(TODAY - DAY_SECONDS)
+    assert save_aggregate_shard(local, "10", {"1": {day: None}}, None, None, NOW) is True
+
+    shard, etag, text = load_aggregate_shard(local, "10")
+    assert shard == {"1": {day: None}}
+    # Today's partial is not persisted, so the shard is unchanged
+    shard["1"][str(TODAY)] = [1, 1, 1, 1, 1, TODAY, 1]
+    assert save_aggregate_shard(local, "10", shard, etag, text, NOW) is False
+
+
+def test_concurrent_aggregate_update_is_merged(local):
+    day1, day2 = str(TODAY - 2 * DAY_SECONDS), str(TODAY - DAY_SECONDS)
+    save_aggregate_shard(local, "10", {"1": {day1: None}}, None, None, NOW)
+    shard, etag, text = load_aggregate_shard(local, "10")
+
+    # Another request writes the shard after this one read it
+    local.put(f"{odr.AGGREGATES_PREFIX}10.json", json.dumps({"1": {day1: None}, "2": {day1: None}}))
+    shard["1"][day2] = None
+    assert save_aggregate_shard(local, "10", shard, etag, text, NOW) is True
+
+    assert load_aggregate_shard(local, "10")[0] == {"1": {day1: None, day2: None}, "2": {day1: None}}
+
+
+def test_evict_uses_retention_not_ttl(local, monkeypatch):
+    monkeypatch.setattr(odr, "REPORT_CACHE_TTL_SECONDS", 0)
+    monkeypatch.setattr(odr, "REPORT_RETENTION_SECONDS", 3600)
+    local.put(f"{odr.REPORTS_PREFIX}k_1.xlsx", b"x")
+    now = datetime.datetime.now().timestamp()
+
+    assert odr.evict_expired_reports(local, now + 60) == 0
+    assert odr.evict_expired_reports(local, now + 7200) == 1
+    assert local.list() == []
+
+
+def test_report_link_expiry_is_capped_at_retention(monkeypatch):
+    monkeypatch.setattr(odr, "REPORT_RETENTION_SECONDS", 10 * 3600)
+    captured = {}
+
+    class AzureStub:
+        kind = "azure"
+        connection_string = "conn"
+        container_name = "metrics-acme"
+
+    def fake_sas(**kwargs):
+        captured.update(kwargs)
+        return "url", kwargs["expiry_hours"]
+
+    monkeypatch.setitem(sys.modules, "send_to_teams", types.SimpleNamespace(generate_blob_sas_url=fake_sas))
+
+    meta = {"created": NOW, "blob": "_cache/reports/k.xlsx"}
+    assert odr.report_link(AzureStub(), "acme", meta, 168, now=NOW + 4 * 3600) == ("url", 6)
+    assert odr.report_link(AzureStub(), "acme", meta, 2, now=NOW) == ("url", 2)
@@ -0,0 +1,81 @@
+import pytest
+
+from metric_catalog import DEFAULT_CATALOG, MetricCatalog
+from rollups import RollupBuilder, Summary, rollup_summary, top_hosts
+
+
+def test_summary_add_is_sample_weighted():
+    summary = Summary()
+    summary.add(1.0, 10.0, 2.0, 1)
+    summary.add(0.0, 5.0, 8.0, 3)
+    assert (summary.min, summary.max, summary.count) == (0.0, 10.0, 4)
+    assert summary.mean == pytest.approx(6.5)
+
+
+def test_summary_merge_with_empty_summary_is_identity():
+    summary = Summary(1.0, 3.0, 20.0, 10)
+    summary.merge(Summary())
+    assert summary.to_list() == [1.0, 3.0, 20.0, 10]
+
+    empty = Summary()
+    empty.merge(Summary(1.0, 3.0, 20.0, 10))
+    assert empty.to_list() == [1.0, 3.0, 20.0, 10]
+
+
+def test_empty_summary_mean_is_zero():
+    assert Summary().mean == 0.0
+
+
+def test_build_merges_hosts_into_groups_and_client():
+    builder = RollupBuilder()
+    builder.add("h1", ["web", "prod"], "cpu", 0, 50, 10, 100)
+    builder.add("h2", ["web"], "cpu", 5, 90, 40, 300)
+    index = builder.build(top_n=1)
+
+    web = rollup_summary(index, "cpu", group="web")
+    assert web.mean == pytest.approx(32.5)
+    assert (web.min, web.max, web.count) == (0, 90, 400)
+    assert rollup_summary(index, "cpu", group="prod").mean == 10
+    assert rollup_summary(index, "cpu").count == 400
+    assert top_hosts(index, "cpu") == [("h2", 40)]
+    assert top_hosts(index, "cpu", group="prod") == [("h1", 10)]
+
+
+def test_host_without_groups_is_listed_as_unknown():
+    builder = RollupBuilder()
+    builder.add("h1", [], "cpu", 0, 1, 1, 1)
+    index = builder.build()
+    assert list(index["rollups"]["cpu"]["groups"]) == ["Unknown"]
+    assert top_hosts(index, "cpu", group="Unknown") == [("h1", 1)]
+
+
+def test_series_without_rollup_or_samples_are_ignored():
+    builder = RollupBuilder()
+    builder.add("h1", ["g"], None, 0, 1, 1, 10)
+    builder.add("h1", ["g"], "cpu", 0, 1, 1, 0)
+    assert builder.build()["rollups"] == {}
+
+
+def test_missing_rollup_group_or_host_is_none():
+    index = RollupBuilder().build()
+    assert rollup_summary(index, "cpu") is None
+    assert rollup_summary(None, "cpu") is None
+    assert top_hosts(index, "cpu") == []
+
+
+def test_complement_fallback_only_for_hosts_without_primary_series():
+    catalog = MetricCatalog(DEFAULT_CATALOG)
+    utilization = catalog.resolve("vm.memory.utilization")
+    pavailable = catalog.resolve("vm.memory.size[pavailable]")
+
+    builder = RollupBuilder()
+    # h1 has both: only the utilization series counts
+    builder.add_metric("h1", ["g"], pavailable, 40, 90, 70, 10)
+    builder.add_metric("h1", ["g"], utilization, 10, 60, 30, 10)
+    # h2 only reports available memory: rolled up as 100 - x
+    builder.add_metric("h2", ["g"], pavailable, 40, 90, 80, 10)
+    index = builder.build()
+
+    assert rollup_summary(index, "memory", host="h1").to_list() == [10, 60, 300, 10]
+    assert rollup_summary(index, "memory", host="h2").to_list() == [10, 60, 200, 10]
+    assert rollup_summary(index, "memory", group="g").mean == pytest.approx(25)
@@ -0,0 +1,133 @@
+import io
+import json
+
+import pytest
+from openpyxl import load_workbook
+
+import export_metrics_csv
+import on_demand_report
+from export_metrics_csv import ExportTarget, export_metrics_shared
+from metric_catalog import MetricCatalog
+from rollups import SUMMARY_INDEX_BLOB
+from storage import LocalStorage
+
+CATALOG = [{"key": "system.cpu.util", "unit": "%", "rollup": "cpu"}]
+
+GROUPS = [
+    {"groupid": "1", "name": "TenantA"},
+    {"groupid": "2", "name": "TenantB"},
+    {"groupid": "3", "name": "Linux servers"},
+]
+
+# a1 is TenantA only, b1 TenantB only, shared is in both tenants' groups
+HOSTS = [
+    {"hostid": "10", "host": "a1", "groups": [GROUPS[0], GROUPS[2]]},
+    {"hostid": "11", "host": "shared", "groups": [GROUPS[0], GROUPS[1]]},
+    {"hostid": "12", "host": "b1", "groups": [GROUPS[1]]},
+]
+
+
+def fake_zabbix_api(url, method, params, auth=None):
+    if method == "user.login":
+        return "token"
+    if method == "apiinfo.version":
+        return "6.0.0"
+    if method == "hostgroup.get":
+        if "filter" in params:
+            return [g for g in GROUPS if g["name"] in params["filter"]["name"]]
+        return GROUPS
+    if method == "host.get":
+        group_ids = set(params.get("groupids") or [g["groupid"] for g in GROUPS])
+        return [h for h in HOSTS if group_ids & {g["groupid"] for g in h["groups"]}]
+    if method == "item.get":
+        host_ids = params["hostids"] if isinstance(params["hostids"], list) else [params["hostids"]]
+        return [
+            {"itemid": f"{h}1", "hostid": h, "name": "CPU utilization", "key_": "system.cpu.util", "units": "%", "value_type": "0"}
+            for h in host_ids
+        ]
+    if method == "trend.get":
+        clock = params["time_from"] - params["time_from"] % 3600 + 3600
+        return [
+            {"itemid": i, "clock": str(clock), "min": "1", "max": "3", "avg": "2", "num": "60"}
+            for i in params["itemids"]
+        ]
+    raise AssertionError(f"Unexpected Zabbix call {method}")
+
+
+@pytest.fixture(autouse=True)
+def zabbix(monkeypatch):
+    monkeypatch.setattr(export_metrics_csv, "zabbix_api", fake_zabbix_api)
+
+
+def target(tmp_path, client, group_names):
+    return ExportTarget(f"metrics-{client}", MetricCatalog(CATALOG), group_names, LocalStorage(str(tmp_path), f"metrics-{client}"))
+
+
+def test_shared_export_splits_hosts_and_group_names_per_target(tmp_path):
+    a = target(tmp_path, "a", ["TenantA"])
+    b = target(tmp_path, "b", ["TenantB"])
+    export_metrics_shared("url", "user", "password", [a, b])
+
+    for t, own, hosts in ((a, "TenantA", ["a1", "shared"]), (b, "TenantB", ["b1", "shared"])):
+        assert sorted(o.name for o in t.storage.list() if o.name.endswith(".csv")) == [f"{h}.csv" for h in hosts]
+
+        info = json.loads(t.storage.get_text("_hostgroups_info.json"))
+        assert [g["name"] for g in info["groups"].values()] == [own]
+        assert info["host_to_groups"] == {h: [own] for h in hosts}
+
+        index = json.loads(t.storage.get_text(SUMMARY_INDEX_BLOB))
+        assert list(index["rollups"]["cpu"]["groups"]) == [own]
+        assert sorted(index["rollups"]["cpu"]["hosts"]) == hosts
+
+        assert t.storage.get_text("shared.csv").splitlines()[1].split(",")[5] == own
+
+
+def test_shared_server_with_unfiltered_target_is_refused(tmp_path):
+    a = target(tmp_path, "a", ["TenantA"])
+    b = target(tmp_path, "b", None)
+    with pytest.raises(ValueError, match="metrics-b"):
+        export_metrics_shared("url", "user", "password", [a, b])
+    assert a.storage.list() == [] and b.storage.list() == []
+
+
+def test_single_unfiltered_target_gets_every_host_and_group(tmp_path):
+    a = target(tmp_path, "a", None)
+    export_metrics_shared("url", "user", "password", [a])
+
+    info = json.loads(a.storage.get_text("_hostgroups_info.json"))
+    assert info["host_to_groups"]["shared"] == ["TenantA", "TenantB"]
+    assert len(info["groups"]) == len(GROUPS)
+
+
+def test_on_demand_report_only_shows_the_clients_groups(local):
+    meta = on_demand_report.build_on_demand_report(
+        local, "acme", ("url", "user", "password"), MetricCatalog(CATALOG),
+        days=2, group_names=["TenantA"], group_filter=["TenantA"]
+    )
+    assert meta["hosts"] == 2
+
+    workbook = load_workbook(io.BytesIO(local.get(meta["blob"])))
+    values = [
+        str(cell.value) for sheet in workbook.worksheets
+        for row in sheet.iter_rows() for cell in row if cell.value is not None
+    ]
+    assert any("TenantA" in v for v in values)
+    assert not any("TenantB" in v or "Linux servers" in v for v in values)
+
+
+def test_function_app_refuses_unfiltered_clients_on_shared_servers(monkeypatch):
+    pytest.importorskip("azure.functions")
+    import function_app
+
+    for client in ("a", "b"):
+        monkeypatch.setenv(f"ZABBIX_URL_{client.upper()}", "https://zabbix.example.com/api_jsonrpc.php")
+        monkeypatch.setenv(f"ZABBIX_USER_{client.upper()}", "user")
+        monkeypatch.setenv(f"ZABBIX_PASSWORD_{client.upper()}", "password")
+    monkeypatch.setenv("ZABBIX_HOSTGROUPS_A", "TenantA")
+    monkeypatch.delenv("ZABBIX_HOSTGROUPS_B", raising=False)
+
+    server_groups, failures = function_app._group_clients_by_server(["a", "b", "c"])
+    assert [clients for _, clients in server_groups] == [["a", "b"]]
+    assert [client for client, _ in failures] == ["c"]
+    assert function_app._unfiltered_shared_clients(["a", "b"]) == ["b"]
+    assert function_app._unfiltered_shared_clients(["b"]) == []
@@ -0,0 +1,77 @@
+import io
+
+import pytest
+
+import storage
+from storage import LocalStorage
+
+
+@pytest.fixture
+def mmap_everything(monkeypatch):
+    monkeypatch.setattr(storage, "MMAP_THRESHOLD_BYTES", 0)
+
+
+def test_put_get_roundtrip_and_list(local):
+    local.put("host1.csv", "a,b\n")
+    local.put("_cache/reports/x.json", b"{}")
+
+    assert local.get_text("host1.csv") == "a,b\n"
+    assert sorted(o.name for o in local.list()) == ["_cache/reports/x.json", "host1.csv"]
+    assert [o.name for o in local.list("_cache/")] == ["_cache/reports/x.json"]
+
+
+def test_ensure_container_reports_creation(tmp_path):
+    store = LocalStorage(str(tmp_path), "metrics-new")
+    assert store.ensure_container() is True
+    assert store.ensure_container() is False
+
+
+@pytest.mark.parametrize("name", ["../metrics-other/host.csv", "..", "a/../../escape.csv", "a/../.."])
+def test_names_escaping_the_container_are_rejected(local, name):
+    with pytest.raises(ValueError):
+        local.put(name, "x")
+    with pytest.raises(ValueError):
+        local.exists(name)
+
+
+def test_dotdot_inside_the_container_is_allowed(local):
+    local.put("a/../host.csv", "x")
+    assert local.exists("host.csv")
+
+
+def test_sibling_container_with_common_prefix_is_rejected(tmp_path, local):
+    # "metrics-acme2" starts with "metrics-acme" but is another container
+    with pytest.raises(ValueError):
+        local.put("../metrics-acme2/host.csv", "x")
+
+
+def test_mmap_stream_reads_and_seeks(local, mmap_everything):
+    local.put("big.bin", b"0123456789")
+    with local.stream("big.bin") as f:
+        assert isinstance(f, io.BufferedReader)
+        assert f.read(4) == b"0123"
+        f.seek(8)
+        assert f.read() == b"89"
+    assert local.get("big.bin") == b"0123456789"
+
+
+def test_zero_byte_file_with_mmap_threshold(local, mmap_everything):
+    local.put("empty.csv", b"")
+    assert local.get("empty.csv") == b""
+
+
+def test_partial_writes_are_not_listed(local):
+    local.put("host1.csv", "x")
+    (open(f"{local.path}/host2.csv.part", "wb")).close()
+    assert [o.name for o in local.list()] == ["host1.csv"]
+
+
+@pytest.mark.parametrize("name, content_type", [
+    ("Zabbix_Report_20240101_000000.html", "text/html; charset=utf-8"),
+    ("Zabbix_Report_20240101_000000.csv.gz", "application/gzip"),
+    ("host1.csv", "text/csv; charset=utf-8"),
+    ("Zabbix_Report_20240101_000000_compact.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ("archive.bin", None),
+])
+def test_content_type_for(name, content_type):
+    assert storage.content_type_for(name) == content_type
@@ -1,5 +1,5 @@
 terraform {
-  required_version = ">= 1.0"
+  required_version = ">= 1.3"
   required_providers {
     azurerm = {
       source  = "hashicorp/azurerm"
@@ -35,11 +35,12 @@ variable "subscription_id" {
 }
 
 variable "clients" {
-  description = "Map of clients and their Zabbix credentials. Define this in terraform.tfvars"
+  description = "Map of clients, their Zabbix credentials and optional host group filter. Define this in terraform.tfvars"
   type = map(object({
-    url  = string
-    user = string
-    pass = string
+    url        = string
+    user       = string
+    pass       = string
+    hostgroups = optional(list(string), [])
   }))
 }
 
@@ -419,6 +420,10 @@ resource "azapi_update_resource" "function_app_settings" {
               {
                 name  = "ZABBIX_PASSWORD_${upper(client_name)}"
                 value = "@Microsoft.KeyVault(SecretUri=${azurerm_key_vault_secret.zabbix_password[client_name].versionless_id})"
+              },
+              {
+                name  = "ZABBIX_HOSTGROUPS_${upper(client_name)}"
+                value = join(",", client_data.hostgroups)
               }
             ]
           ])